@@ -1,16 +1,78 @@
 #!/usr/local/bin/python3
 
+import gzip
+import hashlib
+import itertools
+import json
 import os
+import queue
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote, unquote
 
 library_dir = '/Users/lrazo/Dropbox/IT/repo/archive_tools/library'
 sys.path.append(library_dir)
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 s3 = boto3.resource('s3')
 
 s3_client = boto3.client('s3')
 
+# Backups upload BACKUP_WORKERS files at a time. Files at least
+# MULTIPART_THRESHOLD bytes go up as multipart uploads, each sending
+# MULTIPART_CONCURRENCY parts of MULTIPART_CHUNKSIZE at once; smaller files
+# take a single PUT. The scanner stays at most BACKUP_QUEUE_SIZE files
+# ahead of the uploads.
+BACKUP_WORKERS = 16
+BACKUP_QUEUE_SIZE = 1000
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+PROGRESS_INTERVAL = 5
+
+# Incremental backups keep a manifest of what each backup has uploaded,
+# one SQLite file per bucket and set of directories.
+MANIFEST_DIR = os.path.expanduser('~/.cache/aws_tools/manifests')
+MANIFEST_COMMIT_INTERVAL = 1000
+# delete_objects takes at most 1000 keys per request. Bulk deletes keep
+# DELETE_WORKERS of those requests in flight, and retry keys that failed
+# with one of the transient error codes up to DELETE_RETRIES times.
+DELETE_BATCH_SIZE = 1000
+DELETE_WORKERS = 8
+DELETE_RETRIES = 5
+RETRYABLE_DELETE_ERRORS = ('InternalError', 'SlowDown', 'ServiceUnavailable', 'RequestTimeout')
+
+# Packed backups bundle files smaller than PACK_FILE_THRESHOLD into pack
+# objects of about PACK_SIZE under PACK_PREFIX, each streamed up as a
+# multipart upload of PACK_PART_SIZE parts (at most PACK_PARTS_AHEAD in
+# flight) and followed by an index object of offsets. Manifests record
+# packed files with the pack as their ETag.
+PACK_PREFIX = 'packs/'
+PACK_FILE_THRESHOLD = 1024 * 1024
+PACK_SIZE = 256 * 1024 * 1024
+PACK_PART_SIZE = 16 * 1024 * 1024
+PACK_PARTS_AHEAD = 4
+PACK_ETAG_PREFIX = 'pack:'
+# Packs are append-only. A packed file removed with --delete-removed keeps
+# its bytes in its pack, and is listed in a removal record under
+# PACK_PREFIX so that restores leave it out. Packed copies superseded by a
+# newer pack or a plain object aren't reclaimed either; restores just take
+# the newest copy. A plain object superseded by a packed copy is deleted.
+PACK_REMOVED_SUFFIX = '.removed.json.gz'
+# Pack indexes carry the first and last keys they hold, cut to this many
+# characters to stay well inside the 2 KB limit on user metadata.
+PACK_KEY_RANGE_CHARS = 64
+
+# Backed up objects carry their file's mtime (in ns) in this metadata key,
+# which restores put back.
+MTIME_METADATA_KEY = 'mtime'
+
 def bucket_exists(bucket_name):
     try:
         s3.meta.client.head_bucket(Bucket=bucket_name)
@@ -68,10 +130,11 @@ def get_bucket(bucket_name):
 
 def put_object(bucket, object_key, data):
 
-    put_data = open(data, 'rb')
-    obj = bucket.Object(object_key)
-    obj.put(Body=put_data)
-    obj.wait_until_exists()
+    # S3 is read-after-write consistent, so there's no need to wait for
+    # the object to show up.
+    with open(data, 'rb') as put_data:
+        obj = bucket.Object(object_key)
+        obj.put(Body=put_data)
     
 def delete_object(bucket, object_key):
 
@@ -80,7 +143,979 @@ def delete_object(bucket, object_key):
    
     obj = bucket.Object(object_key)
     obj.delete()
-    obj.wait_until_not_exists()
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+
+
+class BackupProgress:
+    """Thread-safe file and byte counters for a backup, printing rate and ETA."""
+
+    def __init__(self, verb='Uploaded', interval=PROGRESS_INTERVAL):
+        self.lock = threading.Lock()
+        self.verb = verb
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.scanning = True
+        self.files_found = 0
+        self.bytes_found = 0
+        self.files_done = 0
+        self.bytes_done = 0
+
+    def found(self, size):
+        with self.lock:
+            self.files_found += 1
+            self.bytes_found += size
+
+    def sent(self, size):
+        # Also the Callback of multipart uploads, called from their threads.
+        with self.lock:
+            self.bytes_done += size
+            if time.monotonic() - self.last_report >= self.interval:
+                self.report()
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+
+    def report(self):
+        now = time.monotonic()
+        self.last_report = now
+        rate = self.bytes_done / max(now - self.start, 0.001)
+        if self.scanning:
+            eta = 'scanning'
+        elif rate:
+            eta = 'ETA %ds' % ((self.bytes_found - self.bytes_done) / rate)
+        else:
+            eta = 'ETA unknown'
+        print('%s %d/%d files, %s of %s, %s/s, %s' % (
+            self.verb, self.files_done, self.files_found, format_bytes(self.bytes_done),
+            format_bytes(self.bytes_found), format_bytes(rate), eta))
+
+
+def check_backup_dirs(dir_list):
+    """Raises OSError unless every file and directory to back up can be read."""
+    for dir_item in dir_list:
+        if os.path.isfile(dir_item):
+            with open(dir_item, 'rb'):
+                pass
+        else:
+            with os.scandir(dir_item):
+                pass
+
+
+def scan_backup_files(dir_item, errors=None):
+    """
+    Yields (file_name, object_key, size, mtime_ns) for a file, or every file
+    under a directory, keyed by its path relative to the directory.
+    Subdirectories and files that can't be read are reported, skipped and
+    added to errors as a key, or a key prefix ending in '/'. The directory
+    itself must be readable.
+    """
+    if errors is None:
+        errors = []
+    if os.path.isfile(dir_item):
+        stat = os.stat(dir_item)
+        yield os.path.abspath(dir_item), os.path.basename(dir_item), stat.st_size, stat.st_mtime_ns
+        return
+
+    directories = [dir_item]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except OSError as error:
+                        print('Skipping %s: %s' % (entry.path, error))
+                        errors.append(os.path.relpath(entry.path, dir_item).replace(os.sep, '/'))
+                        continue
+                    object_key = os.path.relpath(entry.path, dir_item).replace(os.sep, '/')
+                    yield entry.path, object_key, stat.st_size, stat.st_mtime_ns
+        except OSError as error:
+            if directory == dir_item:
+                raise
+            print('Skipping %s: %s' % (directory, error))
+            errors.append(os.path.relpath(directory, dir_item).replace(os.sep, '/') + '/')
+
+
+def manifest_path(bucket_name, dir_list):
+    backup_id = '\n'.join([bucket_name] + sorted(os.path.abspath(dir_item) for dir_item in dir_list))
+    return os.path.join(MANIFEST_DIR, '%s-%s.db' % (
+        bucket_name, hashlib.sha1(backup_id.encode('utf-8')).hexdigest()[:12]))
+
+
+class BackupManifest:
+    """
+    Object key -> (size, mtime, ETag) of every file a backup has uploaded.
+    Shared by the upload threads; rows are committed in batches.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' key TEXT PRIMARY KEY,'
+            ' size INTEGER,'
+            ' mtime_ns INTEGER,'
+            ' etag TEXT'
+            ') WITHOUT ROWID')
+
+    def unchanged(self, object_key, size, mtime_ns):
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns FROM files WHERE key = ?', (object_key,)).fetchone()
+        return row == (size, mtime_ns)
+
+    def record(self, object_key, size, mtime_ns, etag):
+        """Records an uploaded file. Returns the ETag it replaced, if any."""
+        with self.lock:
+            previous = self.conn.execute('SELECT etag FROM files WHERE key = ?', (object_key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              (object_key, size, mtime_ns, etag))
+            self.pending += 1
+            if self.pending >= MANIFEST_COMMIT_INTERVAL:
+                self.conn.commit()
+                self.pending = 0
+        return previous[0] if previous else None
+
+    def forget(self, object_keys):
+        with self.lock:
+            self.conn.executemany('DELETE FROM files WHERE key = ?', ((key,) for key in object_keys))
+            self.conn.commit()
+
+    def entries(self):
+        """
+        Yields (key, size, etag) in key order, which is the order S3 lists
+        keys in. Only use it while no uploads are recording.
+        """
+        return self.conn.execute('SELECT key, size, etag FROM files ORDER BY key')
+
+    def keys(self):
+        return (row[0] for row in self.entries())
+
+    def keys_with_etag(self, etag):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT key FROM files WHERE etag = ?', (etag,))]
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def upload_backup_file(client, bucket_name, file_name, object_key, size, mtime_ns, transfer_config, progress):
+    """Uploads one file, with its mtime in the object metadata, and returns its ETag."""
+    metadata = {MTIME_METADATA_KEY: str(mtime_ns)}
+    if size >= transfer_config.multipart_threshold:
+        client.upload_file(
+            Filename=file_name,
+            Bucket=bucket_name,
+            Key=object_key,
+            ExtraArgs={'Metadata': metadata},
+            Config=transfer_config,
+            Callback=progress.sent
+        )
+        # upload_file doesn't hand back the completed upload's ETag.
+        return client.head_object(Bucket=bucket_name, Key=object_key)['ETag']
+
+    with open(file_name, 'rb') as data:
+        response = client.put_object(Bucket=bucket_name, Key=object_key, Body=data, Metadata=metadata)
+    progress.sent(size)
+    return response['ETag']
+
+
+def local_etag(file_name, size):
+    """
+    Returns the ETag a backup of the file would have: the MD5 of a single
+    PUT, or for multipart uploads the MD5 of the part MD5s and a part count.
+    """
+    with open(file_name, 'rb') as local_file:
+        if size < MULTIPART_THRESHOLD:
+            return '"%s"' % hashlib.md5(local_file.read()).hexdigest()
+        part_digests = [hashlib.md5(part).digest()
+                        for part in iter(lambda: local_file.read(MULTIPART_CHUNKSIZE), b'')]
+    return '"%s-%d"' % (hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def restore_path(root, object_key):
+    """Maps an object key to a file under root, refusing keys that would escape it."""
+    file_name = os.path.normpath(os.path.join(root, *object_key.split('/')))
+    if not file_name.startswith(root + os.sep):
+        raise ValueError('%s would be written outside %s' % (object_key, root))
+    return file_name
+
+
+def _restore_mtime(file_name, metadata):
+    mtime_ns = metadata.get(MTIME_METADATA_KEY)
+    if mtime_ns:
+        os.utime(file_name, ns=(int(mtime_ns), int(mtime_ns)))
+
+
+def _read_exactly(stream, size, object_key):
+    """Reads size bytes from a response body, raising if it ends early."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(min(size - len(data), MULTIPART_CHUNKSIZE))
+        if not chunk:
+            raise ValueError('%s ended %d bytes short' % (object_key, size - len(data)))
+        data += chunk
+    return bytes(data)
+
+
+def _fetch_range(client, bucket_name, object_key, etag, file_name, start, end, progress):
+    # IfMatch makes every range come from the same version of the object.
+    response = client.get_object(Bucket=bucket_name, Key=object_key, IfMatch=etag,
+                                 Range='bytes=%d-%d' % (start, end - 1))
+    data = _read_exactly(response['Body'], end - start, object_key)
+    fd = os.open(file_name, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, start)
+    finally:
+        os.close(fd)
+    progress.sent(len(data))
+
+
+def restore_object(client, bucket_name, obj, file_name, range_executor, progress):
+    """
+    Restores one listed object to file_name unless the file there already
+    has the same size and ETag. Large objects are fetched as concurrent
+    ranges written in place. Returns whether the object was downloaded.
+    """
+    size = obj['Size']
+    if os.path.isfile(file_name) and os.path.getsize(file_name) == size \
+            and local_etag(file_name, size) == obj['ETag']:
+        return False
+
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    if size < MULTIPART_THRESHOLD:
+        response = client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        with open(file_name, 'wb') as restored:
+            for chunk in response['Body'].iter_chunks(MULTIPART_CHUNKSIZE):
+                restored.write(chunk)
+        progress.sent(size)
+        _restore_mtime(file_name, response.get('Metadata', {}))
+        return True
+
+    head = client.head_object(Bucket=bucket_name, Key=obj['Key'])
+    with open(file_name, 'wb') as restored:
+        restored.truncate(size)
+    ranges = [range_executor.submit(_fetch_range, client, bucket_name, obj['Key'], head['ETag'], file_name,
+                                    start, min(start + MULTIPART_CHUNKSIZE, size), progress)
+              for start in range(0, size, MULTIPART_CHUNKSIZE)]
+    for fetched in ranges:
+        fetched.result()
+    _restore_mtime(file_name, head.get('Metadata', {}))
+    return True
+
+
+def pack_index_key(pack_key):
+    return pack_key[:-len('.pack')] + '.index.json.gz'
+
+
+class PackWriter:
+    """
+    Streams small files into pack objects. Each pack is a multipart upload
+    fed from an in-memory part buffer, so nothing is staged on disk, and is
+    finished with an index object mapping object keys to
+    [offset, size, mtime_ns] in the pack.
+    """
+
+    def __init__(self, client, bucket_name, executor):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.executor = executor
+        self.run_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        self.sequence = itertools.count()
+        self.pack_key = None
+
+    def _start(self):
+        pack_key = '%s%s-%05d.pack' % (PACK_PREFIX, self.run_id, next(self.sequence))
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=pack_key)['UploadId']
+        self.pack_key = pack_key
+        self.buffer = bytearray()
+        self.parts = []
+        self.index = {}
+        self.records = []
+        self.offset = 0
+
+    def _send_part(self):
+        # Waiting for the oldest part caps the memory held by parts in flight.
+        if len(self.parts) >= PACK_PARTS_AHEAD:
+            self.parts[-PACK_PARTS_AHEAD].result()
+        self.parts.append(self.executor.submit(
+            self.client.upload_part, Bucket=self.bucket_name, Key=self.pack_key, UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1, Body=bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def add(self, file_name, object_key, size, mtime_ns):
+        """
+        Appends a file to the current pack. Returns the (file_name,
+        object_key, size, mtime_ns, pack_key) of every file in the pack if
+        this completed it.
+        """
+        with open(file_name, 'rb') as packed_file:
+            data = packed_file.read()
+
+        if self.pack_key is None:
+            self._start()
+        self.index[object_key] = [self.offset, len(data), mtime_ns]
+        self.records.append((file_name, object_key, size, mtime_ns, self.pack_key))
+        self.buffer += data
+        self.offset += len(data)
+
+        if len(self.buffer) >= PACK_PART_SIZE:
+            self._send_part()
+        if self.offset >= PACK_SIZE:
+            return self.finish()
+        return []
+
+    def finish(self):
+        """Completes the current pack, if any, and writes its index. Returns its files like add."""
+        if self.pack_key is None:
+            return []
+        if self.buffer or not self.parts:
+            self._send_part()
+
+        parts = [{'PartNumber': number, 'ETag': part.result()['ETag']}
+                 for number, part in enumerate(self.parts, 1)]
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.pack_key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts})
+        index = {'pack': self.pack_key, 'files': self.index}
+        # The pack is complete now, so there's no upload left to abort.
+        self.upload_id = None
+        # The key range lets a restore of one prefix skip unrelated indexes.
+        # Cut keys still bound the range: the last key starts with its cut.
+        key_range = {'first-key': quote(min(self.index)[:PACK_KEY_RANGE_CHARS]),
+                     'last-key': quote(max(self.index)[:PACK_KEY_RANGE_CHARS])}
+        self.client.put_object(Bucket=self.bucket_name, Key=pack_index_key(self.pack_key),
+                               Body=gzip.compress(json.dumps(index).encode('utf-8')), Metadata=key_range)
+
+        self.pack_key = None
+        return self.records
+
+    def abandon(self):
+        """Aborts the current pack after a failed upload. Returns the files that were in it."""
+        if self.pack_key is None:
+            return []
+        if self.upload_id is None:
+            # Without its index the pack is never read, and its files are
+            # packed again next time.
+            print('%s was written but its index was not.' % self.pack_key)
+        else:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.pack_key,
+                                                   UploadId=self.upload_id)
+            except (BotoCoreError, ClientError) as error:
+                print('Failed to abort the upload of %s: %s' % (self.pack_key, error))
+        self.pack_key = None
+        return self.records
+
+
+def write_removal_record(client, bucket_name, object_keys):
+    """Records packed files that were removed, so restores skip their packed copies."""
+    record_key = '%s%s%s' % (PACK_PREFIX, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), PACK_REMOVED_SUFFIX)
+    client.put_object(Bucket=bucket_name, Key=record_key,
+                      Body=gzip.compress(json.dumps({'removed': sorted(object_keys)}).encode('utf-8')))
+    return record_key
+
+
+def load_pack_index(client, bucket_name, index_key):
+    body = client.get_object(Bucket=bucket_name, Key=index_key)['Body'].read()
+    return json.loads(gzip.decompress(body))
+
+
+def _list_pack_objects(client, bucket_name, suffix):
+    paginator = client.get_paginator('list_objects_v2')
+    return [obj for page in paginator.paginate(Bucket=bucket_name, Prefix=PACK_PREFIX)
+            for obj in page.get('Contents', []) if obj['Key'].endswith(suffix)]
+
+
+def list_pack_indexes(client, bucket_name):
+    """Returns the keys of the bucket's pack indexes, oldest pack first."""
+    return [obj['Key'] for obj in _list_pack_objects(client, bucket_name, '.index.json.gz')]
+
+
+def find_packed_file(client, bucket_name, object_key):
+    """
+    Returns (pack_key, offset, size, mtime_ns) of the newest packed copy of
+    object_key, searching the pack indexes from the newest pack back.
+    """
+    for index_key in reversed(list_pack_indexes(client, bucket_name)):
+        index = load_pack_index(client, bucket_name, index_key)
+        if object_key in index['files']:
+            offset, size, mtime_ns = index['files'][object_key]
+            return index['pack'], offset, size, mtime_ns
+    return None
+
+
+def restore_packed_file(bucket_name, object_key, destination):
+    """Restores one packed file, fetching only its bytes from the pack with a ranged GET."""
+    found = find_packed_file(s3_client, bucket_name, object_key)
+    if found is None:
+        print('%s is not in any pack in %s' % (object_key, bucket_name))
+        return False
+
+    pack_key, offset, size, mtime_ns = found
+    if size:
+        response = s3_client.get_object(Bucket=bucket_name, Key=pack_key,
+                                        Range='bytes=%d-%d' % (offset, offset + size - 1))
+        data = _read_exactly(response['Body'], size, pack_key)
+    else:
+        data = b''
+    with open(destination, 'wb') as restored:
+        restored.write(data)
+    os.utime(destination, ns=(mtime_ns, mtime_ns))
+    print('Restored %s from %s to %s' % (object_key, pack_key, destination))
+    return True
+
+
+def restore_pack(client, bucket_name, index, object_keys, root, progress):
+    """
+    Restores the given files of one pack that aren't already on disk with
+    the same size and mtime, streaming the part of the pack that holds
+    them. Returns the number of files written.
+    """
+    wanted = []
+    for object_key in object_keys:
+        offset, size, mtime_ns = index['files'][object_key]
+        file_name = restore_path(root, object_key)
+        progress.found(size)
+        if os.path.isfile(file_name):
+            stat = os.stat(file_name)
+            if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                continue
+        wanted.append((offset, size, mtime_ns, file_name))
+    if not wanted:
+        return 0
+
+    wanted.sort()
+    start = wanted[0][0]
+    end = max(offset + size for offset, size, _, _ in wanted)
+    stream = None
+    if end > start:
+        stream = client.get_object(Bucket=bucket_name, Key=index['pack'],
+                                   Range='bytes=%d-%d' % (start, end - 1))['Body']
+
+    # A pack shorter than its index says raises here, rather than leaving
+    # truncated files that later runs would take as up to date.
+    position = start
+    for offset, size, mtime_ns, file_name in wanted:
+        while position < offset:
+            skipped = stream.read(min(offset - position, MULTIPART_CHUNKSIZE))
+            if not skipped:
+                raise ValueError('%s ended at byte %d, before %s' % (index['pack'], position, file_name))
+            position += len(skipped)
+        data = _read_exactly(stream, size, index['pack']) if size else b''
+        position += size
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'wb') as restored:
+            restored.write(data)
+        os.utime(file_name, ns=(mtime_ns, mtime_ns))
+        progress.sent(size)
+        progress.file_done()
+    return len(wanted)
+
+
+def _index_overlaps(client, bucket_name, index_key, prefix):
+    """Whether a pack index may hold keys under prefix, going by its key range metadata."""
+    metadata = client.head_object(Bucket=bucket_name, Key=index_key).get('Metadata', {})
+    if 'first-key' not in metadata or 'last-key' not in metadata:
+        return True
+    first_key = unquote(metadata['first-key'])
+    last_key = unquote(metadata['last-key'])
+    # Both are cut to PACK_KEY_RANGE_CHARS, so a last key that prefix
+    # extends might really run past it.
+    reaches = last_key >= prefix or prefix.startswith(last_key)
+    return reaches and (first_key < prefix or first_key.startswith(prefix))
+
+
+def load_pack_catalog(client, bucket_name, prefix, executor):
+    """
+    Returns ({object_key: (index, packed_at)}, {object_key: removed_at})
+    for keys under prefix: the newest packed copy of each file that wasn't
+    removed since, and when files were last recorded as removed. With a
+    prefix, indexes whose key range lies outside it aren't downloaded.
+    """
+    index_objects = _list_pack_objects(client, bucket_name, '.index.json.gz')
+    if prefix:
+        overlaps = list(executor.map(
+            lambda obj: _index_overlaps(client, bucket_name, obj['Key'], prefix), index_objects))
+        index_objects = [obj for obj, overlap in zip(index_objects, overlaps) if overlap]
+    indexes = list(executor.map(lambda obj: load_pack_index(client, bucket_name, obj['Key']), index_objects))
+
+    removed = {}
+    for obj in _list_pack_objects(client, bucket_name, PACK_REMOVED_SUFFIX):
+        for object_key in load_pack_index(client, bucket_name, obj['Key'])['removed']:
+            if object_key.startswith(prefix):
+                removed[object_key] = max(removed.get(object_key, obj['LastModified']), obj['LastModified'])
+
+    # Pack names sort by backup time, so later packs replace earlier copies.
+    packed = {}
+    for obj, index in zip(index_objects, indexes):
+        for object_key in index['files']:
+            if object_key.startswith(prefix):
+                packed[object_key] = (index, obj['LastModified'])
+    for object_key, removed_at in removed.items():
+        if object_key in packed and packed[object_key][1] <= removed_at:
+            del packed[object_key]
+    return packed, removed
+
+
+def restore(bucket_name, destination, prefix='', workers=BACKUP_WORKERS):
+    """
+    Restores a backup, or the part of it under prefix, into destination.
+    The listing is streamed into a bounded pool of downloads; objects of
+    MULTIPART_THRESHOLD bytes or more are fetched as concurrent ranged GETs.
+    A file backed up both as an object and in a pack is restored from the
+    newer copy, and packed files removed with --delete-removed are left
+    out. Files already identical on disk are skipped. Returns the keys
+    that failed.
+    """
+    client = boto3.client('s3', config=Config(max_pool_connections=workers * 2))
+    root = os.path.abspath(destination)
+    progress = BackupProgress('Restored')
+    failed = []
+    skipped = 0
+
+    def restore_one(obj):
+        file_name = restore_path(root, obj['Key'])
+        return restore_object(client, bucket_name, obj, file_name, range_executor, progress)
+
+    def newest_copy(obj):
+        # Runs on this thread only, so it can settle packed as it goes.
+        object_key = obj['Key']
+        if object_key in removed and removed[object_key] >= obj['LastModified']:
+            return False
+        if object_key in packed:
+            if packed[object_key][1] > obj['LastModified']:
+                return False
+            del packed[object_key]
+        return True
+
+    paginator = client.get_paginator('list_objects_v2')
+    listed = (obj for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+              for obj in page.get('Contents', [])
+              if not obj['Key'].endswith('/') and not obj['Key'].startswith(PACK_PREFIX))
+
+    with ThreadPoolExecutor(max_workers=workers) as object_executor, \
+            ThreadPoolExecutor(max_workers=workers) as range_executor:
+        packed, removed = load_pack_catalog(client, bucket_name, prefix, object_executor)
+        running = {}
+
+        def collect(futures):
+            nonlocal skipped
+            for future in futures:
+                obj = running.pop(future)
+                try:
+                    if future.result():
+                        progress.file_done()
+                    else:
+                        skipped += 1
+                except (OSError, ValueError, BotoCoreError, ClientError) as error:
+                    print('Failed to restore %s: %s' % (obj['Key'], error))
+                    failed.append(obj['Key'])
+
+        for obj in listed:
+            if not newest_copy(obj):
+                continue
+            progress.found(obj['Size'])
+            running[object_executor.submit(restore_one, obj)] = obj
+            if len(running) >= workers * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(running))
+        progress.scanning = False
+
+        # What's left in packed are files whose newest copy is packed.
+        by_pack = {}
+        for object_key, (index, packed_at) in packed.items():
+            by_pack.setdefault(index['pack'], (index, []))[1].append(object_key)
+        packs = [(pack_key, object_executor.submit(
+                     restore_pack, client, bucket_name, index, object_keys, root, progress))
+                 for pack_key, (index, object_keys) in sorted(by_pack.items())]
+        for pack_key, future in packs:
+            try:
+                future.result()
+            except (OSError, ValueError, BotoCoreError, ClientError) as error:
+                print('Failed to restore pack %s: %s' % (pack_key, error))
+                failed.append(pack_key)
+
+    progress.report()
+    print('%d files already up to date, %d failed.' % (skipped, len(failed)))
+    return failed
+
+
+def iter_object_refs(client, bucket_name, prefix='', versions=False):
+    """
+    Yields {'Key': ...} for every object under prefix, or with versions
+    {'Key': ..., 'VersionId': ...} for every version and delete marker,
+    one listing page at a time.
+    """
+    if versions:
+        paginator = client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
+                yield {'Key': version['Key'], 'VersionId': version['VersionId']}
+    else:
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield {'Key': obj['Key']}
+
+
+def delete_batch(client, bucket_name, refs):
+    """
+    Deletes up to 1000 objects in one DeleteObjects request. Keys that fail
+    with a transient error are sent again, with backoff. Returns the refs
+    that couldn't be deleted.
+    """
+    failed = []
+
+    for attempt in range(DELETE_RETRIES + 1):
+        response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': refs, 'Quiet': True})
+        retry = []
+        for error in response.get('Errors', []):
+            ref = {'Key': error['Key']}
+            if error.get('VersionId'):
+                ref['VersionId'] = error['VersionId']
+            if error.get('Code') in RETRYABLE_DELETE_ERRORS and attempt < DELETE_RETRIES:
+                retry.append(ref)
+            else:
+                print('Failed to delete %s: %s' % (error['Key'], error.get('Message')))
+                failed.append(ref)
+        if not retry:
+            break
+        refs = retry
+        time.sleep(min(2 ** attempt, 30))
+
+    return failed
+
+
+def bulk_delete(bucket_name, refs, workers=DELETE_WORKERS, client=None):
+    """
+    Deletes a stream of object refs, as yielded by iter_object_refs, in
+    1000-key batches with up to workers batches in flight. Prints the
+    delete rate as it goes. Returns the refs that couldn't be deleted.
+    """
+    if client is None:
+        client = boto3.client('s3', config=Config(max_pool_connections=workers))
+
+    refs = iter(refs)
+    batches = iter(lambda: list(itertools.islice(refs, DELETE_BATCH_SIZE)), [])
+    # Listing runs ahead of the deletes, but only by so much. A single
+    # worker lists nothing while a delete is running.
+    ahead = workers * 2 if workers > 1 else 1
+    failed = []
+    deleted = 0
+    start = last_report = time.monotonic()
+
+    def report():
+        elapsed = max(time.monotonic() - start, 0.001)
+        print('Deleted %d objects, %.0f/s' % (deleted, deleted / elapsed))
+
+    def collect(futures):
+        nonlocal deleted
+        for future in futures:
+            batch = running.pop(future)
+            try:
+                batch_failed = future.result()
+            except (BotoCoreError, ClientError) as error:
+                print('Failed to delete a batch of %d objects: %s' % (len(batch), error))
+                batch_failed = batch
+            failed.extend(batch_failed)
+            deleted += len(batch) - len(batch_failed)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while True:
+            while len(running) >= ahead:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    report()
+                    last_report = time.monotonic()
+            batch = next(batches, None)
+            if batch is None:
+                break
+            running[executor.submit(delete_batch, client, bucket_name, batch)] = batch
+        collect(list(running))
+
+    report()
+    return failed
+
+
+def delete_prefix(bucket_name, prefix='', versions=False, workers=DELETE_WORKERS):
+    """
+    Deletes every object under prefix (the whole bucket for an empty
+    prefix), and with versions every noncurrent version and delete marker
+    too, until a listing comes back empty. Returns the number of objects
+    that couldn't be deleted.
+    """
+    client = boto3.client('s3', config=Config(max_pool_connections=workers))
+    failed = []
+
+    # Listing again after each pass also catches objects written while the
+    # delete ran, and versions that listing markers skipped.
+    while not failed:
+        refs = iter_object_refs(client, bucket_name, prefix=prefix, versions=versions)
+        first = next(refs, None)
+        if first is None:
+            break
+        failed = bulk_delete(bucket_name, itertools.chain([first], refs), workers=workers, client=client)
+
+    if failed:
+        print('%d objects could not be deleted.' % len(failed))
+    return len(failed)
+
+
+def empty_and_delete_bucket(bucket_name, workers=DELETE_WORKERS):
+    """Deletes every object version and delete marker in a bucket, then the bucket."""
+    if delete_prefix(bucket_name, versions=True, workers=workers):
+        print('Bucket %s is not empty, not deleting it.' % bucket_name)
+        return False
+
+    s3_client.delete_bucket(Bucket=bucket_name)
+    print('Bucket %s successfully deleted.' % bucket_name)
+    return True
+
+
+def verify_manifest(bucket_name, dir_list, path=None):
+    """
+    Checks an incremental backup's manifest against the bucket, streaming
+    ListObjectsV2 pages alongside the manifest in key order. Entries whose
+    object is missing or has a different size or ETag are dropped from the
+    manifest, so the next incremental backup uploads those files again.
+    Returns the dropped keys.
+    """
+    manifest = BackupManifest(path or manifest_path(bucket_name, dir_list))
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket_name)
+    listed = (obj for page in pages for obj in page.get('Contents', []))
+
+    bad = []
+    checked = 0
+    packs = set()
+    obj = next(listed, None)
+    try:
+        for key, size, etag in manifest.entries():
+            if etag and etag.startswith(PACK_ETAG_PREFIX):
+                # Checked below, one request per pack.
+                packs.add(etag)
+                continue
+            while obj is not None and obj['Key'] < key:
+                obj = next(listed, None)
+            checked += 1
+            if obj is None or obj['Key'] != key:
+                print('Missing from bucket:', key)
+                bad.append(key)
+            elif obj['Size'] != size or obj['ETag'] != etag:
+                print('Changed in bucket:', key)
+                bad.append(key)
+        for pack in packs:
+            try:
+                s3_client.head_object(Bucket=bucket_name, Key=pack[len(PACK_ETAG_PREFIX):])
+            except ClientError:
+                print('Missing from bucket:', pack[len(PACK_ETAG_PREFIX):])
+                bad.extend(manifest.keys_with_etag(pack))
+            checked += 1
+        manifest.forget(bad)
+    finally:
+        manifest.close()
+
+    print('Checked %d manifest entries, %d dropped.' % (checked, len(bad)))
+    return bad
+
+
+def backup(bucket_name, dir_list, workers=BACKUP_WORKERS, incremental=False, delete=False,
+           manifest_file=None, pack=False):
+    """
+    Uploads files and directory trees to a bucket. The directories are
+    scanned into a bounded queue that a pool of upload threads drains, so
+    uploads start with the first file found. Returns the files that failed.
+
+    Incremental backups skip files whose size and mtime match the manifest
+    of earlier runs, and with delete remove objects whose files are gone.
+    With pack, files under PACK_FILE_THRESHOLD are bundled into pack
+    objects instead of taking a PUT each.
+
+    A file or directory in dir_list that can't be read raises OSError, as a
+    backup that saw none of it would have delete remove all of its objects.
+    """
+    check_backup_dirs(dir_list)
+
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=MULTIPART_CONCURRENCY
+    )
+    # Clients are thread-safe; give this one a connection per thread.
+    client = boto3.client('s3', config=Config(max_pool_connections=workers * MULTIPART_CONCURRENCY))
+
+    files = queue.Queue(maxsize=BACKUP_QUEUE_SIZE)
+    progress = BackupProgress()
+    failed = []
+    manifest = None
+    if incremental:
+        manifest = BackupManifest(manifest_file or manifest_path(bucket_name, dir_list))
+
+    def upload_files():
+        while True:
+            item = files.get()
+            if item is None:
+                return
+            file_name, object_key, size, mtime_ns = item
+            try:
+                etag = upload_backup_file(client, bucket_name, file_name, object_key, size, mtime_ns,
+                                          transfer_config, progress)
+            except Exception as error:
+                # Whatever goes wrong fails only this file. A worker that
+                # died would leave the scan blocked on a full queue.
+                print('Failed to archive %s: %s' % (file_name, error))
+                failed.append(file_name)
+            else:
+                progress.file_done()
+                if manifest:
+                    manifest.record(object_key, size, mtime_ns, etag)
+
+    small_files = queue.Queue(maxsize=BACKUP_QUEUE_SIZE)
+    pack_executor = ThreadPoolExecutor(max_workers=PACK_PARTS_AHEAD)
+
+    superseded = []
+
+    def packed(records):
+        for file_name, object_key, size, mtime_ns, pack_key in records:
+            progress.file_done()
+            if manifest:
+                previous = manifest.record(object_key, size, mtime_ns, PACK_ETAG_PREFIX + pack_key)
+                if previous and not previous.startswith(PACK_ETAG_PREFIX):
+                    # The file was a plain object until now.
+                    superseded.append(object_key)
+
+    def pack_files():
+        writer = PackWriter(client, bucket_name, pack_executor)
+        item = True
+        while item is not None:
+            item = small_files.get()
+            try:
+                if item is None:
+                    packed(writer.finish())
+                    continue
+                try:
+                    packed(writer.add(*item))
+                except OSError as error:
+                    print('Failed to archive %s: %s' % (item[0], error))
+                    failed.append(item[0])
+                    continue
+                progress.sent(item[2])
+            except Exception as error:
+                # Anything else fails the pack, not the thread, which would
+                # leave the scan blocked on a full queue.
+                print('Failed to write pack %s: %s' % (writer.pack_key, error))
+                abandoned = [record[0] for record in writer.abandon()]
+                if item is not None and item[0] not in abandoned:
+                    abandoned.append(item[0])
+                failed.extend(abandoned)
+
+    threads = [threading.Thread(target=upload_files, daemon=True) for _ in range(workers)]
+    if pack:
+        threads.append(threading.Thread(target=pack_files, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    seen = set()
+    scan_errors = []
+    unchanged = 0
+    scanned = False
+    try:
+        for dir_item in dir_list:
+            print('Scanning:', dir_item)
+            for item in scan_backup_files(dir_item, scan_errors):
+                file_name, object_key, size, mtime_ns = item
+                seen.add(object_key)
+                if manifest and manifest.unchanged(object_key, size, mtime_ns):
+                    unchanged += 1
+                    continue
+                progress.found(size)
+                if pack and size < PACK_FILE_THRESHOLD:
+                    small_files.put(item)
+                else:
+                    files.put(item)
+        scanned = True
+    finally:
+        # Finish what was queued even if the scan failed, which then skips
+        # the delete pass below.
+        progress.scanning = False
+        for _ in range(workers):
+            files.put(None)
+        small_files.put(None)
+        for thread in threads:
+            thread.join()
+        pack_executor.shutdown()
+        if manifest and not scanned:
+            manifest.close()
+
+    progress.report()
+    if manifest:
+        print('%d files unchanged since the last backup.' % unchanged)
+    if failed:
+        print('%d files failed to archive.' % len(failed))
+
+    if superseded:
+        print('Deleting %d objects whose files are now packed...' % len(superseded))
+        not_deleted = bulk_delete(bucket_name, ({'Key': key} for key in superseded), client=client)
+        if not_deleted:
+            print('%d superseded objects could not be deleted.' % len(not_deleted))
+
+    if manifest and delete:
+        removed = []
+        removed_packed = []
+        unscanned = 0
+        for key, size, etag in manifest.entries():
+            if key not in seen:
+                # A file under a path that couldn't be read may well still be there.
+                if any(key == error or (error.endswith('/') and key.startswith(error))
+                       for error in scan_errors):
+                    unscanned += 1
+                    continue
+                if etag and etag.startswith(PACK_ETAG_PREFIX):
+                    removed_packed.append(key)
+                else:
+                    removed.append(key)
+        if removed:
+            print('Deleting %d objects whose files were removed...' % len(removed))
+            refs = ({'Key': key} for key in removed)
+            not_deleted = set(ref['Key'] for ref in bulk_delete(bucket_name, refs, client=client))
+            manifest.forget(key for key in removed if key not in not_deleted)
+        if removed_packed:
+            # Packed files aren't objects of their own, so there's nothing to delete.
+            try:
+                record_key = write_removal_record(client, bucket_name, removed_packed)
+            except (BotoCoreError, ClientError) as error:
+                print('Failed to record %d removed packed files: %s' % (len(removed_packed), error))
+            else:
+                print('Recorded %d removed packed files in %s.' % (len(removed_packed), record_key))
+                manifest.forget(removed_packed)
+        if unscanned:
+            print('Kept %d objects under paths that could not be scanned.' % unscanned)
+    if manifest:
+        manifest.close()
+
+    return failed
+
 
 if __name__ == '__main__':
     import argparse
@@ -93,9 +1128,22 @@ if __name__ == '__main__':
     parser.add_argument('--create', action='store_true', help="Create new bucket")
     parser.add_argument('--backup', action='store_true', help="Backup all objects in a directory to a bucket")
     parser.add_argument('--delete', action='store_true', help="Delete bucket")
+    parser.add_argument('--empty', action='store_true', help="Delete every object in a bucket (with --versions, every version)")
+    parser.add_argument('--force-delete', action='store_true', help="Delete every object version in a bucket, then the bucket")
+    parser.add_argument('--delete-prefix', metavar='prefix', help="Delete every object under a prefix")
+    parser.add_argument('--versions', action='store_true', help="Also delete noncurrent versions and delete markers")
+    parser.add_argument('-y', '--yes', action='store_true', help="Don't ask before --empty, --force-delete or --delete-prefix")
     parser.add_argument('--exists', action='store_true', help="Check if named bucket exists")
     parser.add_argument('--put-obj', action='store_true', help="Put object in designated bucket")
     parser.add_argument('--del-obj', action='store_true', help="Delete object from designated bucket")
+    parser.add_argument('-i', '--incremental', action='store_true', help="Only back up files that changed since the last --backup")
+    parser.add_argument('--delete-removed', action='store_true', help="With --incremental, delete objects whose files are gone")
+    parser.add_argument('--restore', metavar='directory', help="Restore a backup (or the part under --prefix) into a directory")
+    parser.add_argument('--prefix', default='', help="Only restore objects under this prefix")
+    parser.add_argument('--pack', action='store_true', help="With --backup, bundle small files into pack objects")
+    parser.add_argument('--restore-packed', metavar='object_key', help="Restore one packed file to --object (default: its base name)")
+    parser.add_argument('--verify-manifest', action='store_true', help="Check the incremental backup manifest of --dir against the bucket")
+    parser.add_argument('-w', '--workers', type=int, default=BACKUP_WORKERS, help="Files uploaded at once by --backup, or delete batches in flight")
     parser.add_argument('--debug', action='store_true', help="Print debug info")
     args = parser.parse_args()
 
@@ -114,6 +1162,24 @@ if __name__ == '__main__':
         new_bucket = create_bucket(bucket_name)
         print('New bucket:', new_bucket)
 
+    def confirmed(what):
+        if args.yes:
+            return True
+        confirm = input('Are you SURE you want to %s (CANNOT BE UNDONE)? ' % what)
+        return confirm.casefold() == 'y'
+
+    if args.delete_prefix:
+        if confirmed('delete everything under %s in %s' % (args.delete_prefix, bucket_name)):
+            delete_prefix(bucket_name, args.delete_prefix, versions=args.versions, workers=args.workers)
+
+    if args.empty:
+        if confirmed('empty %s' % bucket_name):
+            delete_prefix(bucket_name, versions=args.versions, workers=args.workers)
+
+    if args.force_delete:
+        if confirmed('empty and delete %s' % bucket_name):
+            empty_and_delete_bucket(bucket_name, workers=args.workers)
+
     if args.delete:
         delete_bucket(bucket_name)
 
@@ -146,36 +1212,23 @@ if __name__ == '__main__':
             delete_object(bucket, object_name)
 
     if args.backup:
-        bucket = get_bucket(bucket_name)
-        dir_list = []
-        if args.dir:
-            dir_list = args.dir
-        else:
+        if not args.dir:
             print('Must specify local directory to backup. Exiting.')
             exit()
 
-        file_list = []
-        print('Scanning...')
-        for dir_item in dir_list:
-            print('Checking dir_item:', dir_item)
-            if os.path.isfile(dir_item):
-                file_list.append(os.path.abspath(dir_item))
-            elif os.path.isdir(dir_item):
-                for dirname, subdirs, filelist in os.walk(dir_item):
-                    for filename in filelist:
-                        file_list.append(os.path.join(dirname, filename))
-
-            for file in file_list:
-                print('Archiving:', str(file) + '...')
-                object_key = os.path.relpath(file, dir_item)
-                #print('\tOBJECT KEY:', object_key)
-                put_object(bucket, object_key, file)
-
-#                s3_client.upload_file(
-#                    Filename = file, 
-#                    Bucket = bucket, 
-#                    Key = object_key,
-#                    ExtraArgs = {
-#                      'StorageClass': 'STANDARD_IA'
-#                    }
-#                )
+        backup(bucket_name, args.dir, workers=args.workers, incremental=args.incremental,
+               delete=args.delete_removed, pack=args.pack)
+
+    if args.restore:
+        restore(bucket_name, args.restore, prefix=args.prefix, workers=args.workers)
+
+    if args.restore_packed:
+        restore_packed_file(bucket_name, args.restore_packed,
+                            args.object or os.path.basename(args.restore_packed))
+
+    if args.verify_manifest:
+        if not args.dir:
+            print('Must specify the backed up directories. Exiting.')
+            exit()
+
+        verify_manifest(bucket_name, args.dir)
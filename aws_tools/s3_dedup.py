@@ -0,0 +1,463 @@
+#!/usr/local/bin/python3
+
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws_s3_test import BackupProgress, format_bytes, scan_backup_files
+
+try:
+    import numpy
+except ImportError:
+    # Without numpy, cut points are found by a pure Python loop over every
+    # byte, which is slower than uploading on any fast link.
+    numpy = None
+
+# Deduplicated backups. Files are cut into content-defined chunks with a
+# gear rolling hash, so an edit only changes the chunks around it, and each
+# chunk is stored once as chunks/<sha256>. A backup uploads the chunks the
+# bucket doesn't have yet and writes a snapshot object listing every file's
+# chunks; a restore fetches the chunks in parallel and writes them in place.
+#
+#     ./s3_dedup.py -n my-bucket --backup -d /var/lib/images
+#     ./s3_dedup.py -n my-bucket --restore latest --to /tmp/restore
+
+CHUNK_PREFIX = 'chunks/'
+SNAPSHOT_PREFIX = 'snapshots/'
+
+# Chunks are between CHUNK_MIN and CHUNK_MAX bytes, about CHUNK_AVG on
+# average. Cut points are harder to hit before CHUNK_AVG and easier after
+# it, which keeps sizes close to the average.
+CHUNK_MIN = 512 * 1024
+CHUNK_AVG = 2 * 1024 * 1024
+CHUNK_MAX = 8 * 1024 * 1024
+CUT_MASK_STRICT = ((1 << 23) - 1) << 9
+CUT_MASK_LOOSE = ((1 << 19) - 1) << 13
+# The 32-bit gear hash only depends on the last 32 bytes, so files are
+# scanned for cut points in SCAN_SEGMENT pieces on all cores, each piece
+# starting 32 bytes early, with the same result as one sequential scan.
+GEAR_WINDOW = 32
+SCAN_SEGMENT = 32 * 1024 * 1024
+# Fixed pseudo-random gear table. Changing it changes every cut point.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:4], 'big') for byte in range(256)]
+# With numpy the hashes are computed SCAN_BLOCK bytes at a time, small
+# enough for the working arrays to stay in the CPU cache.
+SCAN_BLOCK = 64 * 1024
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy else None
+
+DEDUP_WORKERS = 16
+CHUNK_INDEX_DIR = os.path.expanduser('~/.cache/aws_tools/chunks')
+
+
+def _cut_candidates(file_name, start, end):
+    """
+    Returns [(position, strict)] for every byte in [start, end) of a file
+    where the loose cut mask matches; strict says whether the strict one
+    does too. Runs in a worker process.
+    """
+    gear = GEAR
+    loose = CUT_MASK_LOOSE
+    strict = CUT_MASK_STRICT
+    warm_up = min(start, GEAR_WINDOW)
+
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        data = os.pread(fd, end - start + warm_up, start - warm_up)
+    finally:
+        os.close(fd)
+
+    if numpy is not None:
+        return _cut_candidates_numpy(data, warm_up, start)
+
+    h = 0
+    for byte in data[:warm_up]:
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+
+    candidates = []
+    position = start
+    for byte in data[warm_up:]:
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        position += 1
+        if not h & loose:
+            candidates.append((position, not h & strict))
+    return candidates
+
+
+def _gear_hashes(data):
+    """
+    Returns the gear hash at every byte of data, as if hashing started at
+    its first byte. Each hash is the sum of the last 32 gear values shifted
+    by their distance, so it is built by doubling the window five times
+    instead of stepping through the bytes.
+    """
+    h = numpy.take(GEAR_ARRAY, numpy.frombuffer(data, dtype=numpy.uint8))
+    earlier = numpy.empty_like(h)
+    width = 1
+    while width < GEAR_WINDOW:
+        numpy.left_shift(h[:-width], width, out=earlier[width:])
+        numpy.add(h[width:], earlier[width:], out=h[width:])
+        width *= 2
+    return h
+
+
+def _cut_candidates_numpy(data, warm_up, start):
+    """_cut_candidates for data whose first warm_up bytes only prime the hash."""
+    loose = numpy.uint32(CUT_MASK_LOOSE)
+    strict = numpy.uint32(CUT_MASK_STRICT)
+    data = memoryview(data)
+    candidates = []
+    for block_start in range(warm_up, len(data), SCAN_BLOCK):
+        # Each block brings the 31 bytes before it, so its hashes are exact.
+        context = min(block_start, GEAR_WINDOW - 1)
+        h = _gear_hashes(data[block_start - context:block_start + SCAN_BLOCK])[context:]
+        hits = numpy.flatnonzero((h & loose) == 0)
+        strict_hits = (h[hits] & strict) == 0
+        base = start + block_start - warm_up + 1
+        candidates.extend(zip((base + hits).tolist(), strict_hits.tolist()))
+    return candidates
+
+
+def select_cuts(candidates, size):
+    """Returns the end offsets of a file's chunks, given its cut candidates in order."""
+    cuts = []
+    start = 0
+    for position, strict in candidates:
+        while position - start > CHUNK_MAX:
+            start += CHUNK_MAX
+            cuts.append(start)
+        length = position - start
+        if length < CHUNK_MIN or (length < CHUNK_AVG and not strict):
+            continue
+        cuts.append(position)
+        start = position
+
+    while size - start > CHUNK_MAX:
+        start += CHUNK_MAX
+        cuts.append(start)
+    if start < size:
+        cuts.append(size)
+    return cuts
+
+
+def chunk_index_path(bucket_name):
+    return os.path.join(CHUNK_INDEX_DIR, bucket_name + '.db')
+
+
+class ChunkIndex:
+    """Local record of the chunks a bucket holds, shared by the upload threads."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER) WITHOUT ROWID')
+
+    def __contains__(self, digest):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM chunks WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def add(self, digests):
+        """Records (digest, size) pairs."""
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?)', digests)
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM chunks')
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def refresh_chunk_index(client, bucket_name, index):
+    """Rebuilds the local chunk index from a listing of the bucket's chunks."""
+    index.clear()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=CHUNK_PREFIX):
+        index.add((obj['Key'][len(CHUNK_PREFIX):], obj['Size']) for obj in page.get('Contents', []))
+    print('Chunk index holds %d chunks.' % len(index))
+
+
+def list_snapshots(client, bucket_name):
+    """Returns the bucket's snapshot names, oldest first."""
+    paginator = client.get_paginator('list_objects_v2')
+    return [obj['Key'][len(SNAPSHOT_PREFIX):]
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=SNAPSHOT_PREFIX)
+            for obj in page.get('Contents', [])]
+
+
+def load_snapshot(client, bucket_name, snapshot='latest'):
+    """Returns a snapshot's manifest, or None if the bucket has no snapshots."""
+    if snapshot == 'latest':
+        snapshots = list_snapshots(client, bucket_name)
+        if not snapshots:
+            return None
+        snapshot = snapshots[-1]
+    body = client.get_object(Bucket=bucket_name, Key=SNAPSHOT_PREFIX + snapshot)['Body'].read()
+    return json.loads(gzip.decompress(body))
+
+
+def _store_chunk(client, bucket_name, file_name, offset, size, index, claimed, claimed_lock):
+    """
+    Reads and hashes one chunk and uploads it unless the bucket already has
+    it. Returns (digest, bytes uploaded).
+    """
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        data = os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+    if len(data) != size:
+        raise ValueError('%s changed while it was backed up' % file_name)
+
+    digest = hashlib.sha256(data).hexdigest()
+    with claimed_lock:
+        if digest in claimed:
+            return digest, 0
+        claimed.add(digest)
+    if digest in index:
+        return digest, 0
+
+    client.put_object(Bucket=bucket_name, Key=CHUNK_PREFIX + digest, Body=data)
+    index.add([(digest, size)])
+    return digest, size
+
+
+def dedup_backup(bucket_name, dir_list, workers=DEDUP_WORKERS, processes=None, refresh_index=False):
+    """
+    Backs up files and directory trees as deduplicated chunks plus a
+    snapshot. Files whose size and mtime match the previous snapshot reuse
+    its chunk list without being read. Returns the snapshot name, or None if
+    some files failed and no snapshot was written.
+    """
+    client = boto3.client('s3', config=Config(max_pool_connections=workers))
+    index = ChunkIndex(chunk_index_path(bucket_name))
+    if refresh_index or not len(index):
+        refresh_chunk_index(client, bucket_name, index)
+
+    previous = load_snapshot(client, bucket_name) or {'files': []}
+    previous_files = dict((entry['key'], entry) for entry in previous['files'])
+
+    progress = BackupProgress()
+    claimed = set()
+    claimed_lock = threading.Lock()
+    entries = []
+    failed = []
+    unchanged = 0
+
+    def scan():
+        for dir_item in dir_list:
+            print('Scanning:', dir_item)
+            for item in scan_backup_files(dir_item):
+                yield item
+
+    with ProcessPoolExecutor(max_workers=processes) as scanners, \
+            ThreadPoolExecutor(max_workers=workers) as uploaders:
+        # Files waiting for their cut points, scanned at most a few
+        # segments per process ahead.
+        scanning = deque()
+        ahead = (processes or os.cpu_count() or 1) * 4
+        stores = []
+
+        def cut_next():
+            file_name, entry, segments = scanning.popleft()
+            try:
+                candidates = itertools.chain.from_iterable(segment.result() for segment in segments)
+                cuts = select_cuts(candidates, entry['size'])
+            except OSError as error:
+                print('Failed to back up %s: %s' % (file_name, error))
+                failed.append(file_name)
+                return
+            chunk_futures = []
+            for offset, cut in zip([0] + cuts[:-1], cuts):
+                future = uploaders.submit(_store_chunk, client, bucket_name, file_name, offset, cut - offset,
+                                          index, claimed, claimed_lock)
+                future.add_done_callback(lambda _, size=cut - offset: progress.sent(size))
+                chunk_futures.append((cut - offset, future))
+            stores.append((file_name, entry, chunk_futures))
+
+        for file_name, object_key, size, mtime_ns in scan():
+            entry = {'key': object_key, 'size': size, 'mtime_ns': mtime_ns}
+            old = previous_files.get(object_key)
+            if old and old['size'] == size and old['mtime_ns'] == mtime_ns:
+                entries.append(old)
+                unchanged += 1
+                continue
+
+            progress.found(size)
+            if size > CHUNK_MIN:
+                segments = [scanners.submit(_cut_candidates, file_name, start, min(start + SCAN_SEGMENT, size))
+                            for start in range(0, size, SCAN_SEGMENT)]
+            else:
+                segments = []
+            scanning.append((file_name, entry, segments))
+            while sum(len(segments) for _, _, segments in scanning) > ahead:
+                cut_next()
+        progress.scanning = False
+        while scanning:
+            cut_next()
+
+        uploaded = 0
+        for file_name, entry, chunk_futures in stores:
+            chunks = []
+            try:
+                for size, future in chunk_futures:
+                    digest, sent = future.result()
+                    chunks.append([digest, size])
+                    uploaded += sent
+            except (OSError, ValueError, BotoCoreError, ClientError) as error:
+                print('Failed to back up %s: %s' % (file_name, error))
+                failed.append(file_name)
+                continue
+            entry['chunks'] = chunks
+            entries.append(entry)
+            progress.file_done()
+    index.close()
+
+    progress.report()
+    print('%d files unchanged, %s of new chunks uploaded.' % (unchanged, format_bytes(uploaded)))
+    if failed:
+        print('%d files failed, no snapshot written.' % len(failed))
+        return None
+
+    snapshot = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) + '.json.gz'
+    manifest = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'sources': [os.path.abspath(dir_item) for dir_item in dir_list],
+        'files': entries,
+    }
+    client.put_object(Bucket=bucket_name, Key=SNAPSHOT_PREFIX + snapshot,
+                      Body=gzip.compress(json.dumps(manifest).encode('utf-8')))
+    print('Snapshot %s written, %d files.' % (snapshot, len(entries)))
+    return snapshot
+
+
+def _fetch_chunk(client, bucket_name, digest, targets):
+    """Downloads one chunk, checks its hash and writes it at each (file_name, offset) in targets."""
+    data = client.get_object(Bucket=bucket_name, Key=CHUNK_PREFIX + digest)['Body'].read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError('chunk %s is corrupt' % digest)
+
+    for file_name, offset in targets:
+        fd = os.open(file_name, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+    return len(data)
+
+
+def dedup_restore(bucket_name, destination, snapshot='latest', prefix='', workers=DEDUP_WORKERS):
+    """
+    Restores a snapshot, or the files in it under prefix, into destination.
+    Files are created at full size up front and each distinct chunk is
+    fetched once, in parallel, and written wherever it belongs. Only files
+    whose every chunk was written get their original mtime back. Returns
+    the keys of the files that are incomplete.
+    """
+    client = boto3.client('s3', config=Config(max_pool_connections=workers))
+    manifest = load_snapshot(client, bucket_name, snapshot)
+    if manifest is None:
+        print('Bucket %s has no snapshots.' % bucket_name)
+        return []
+
+    root = os.path.abspath(destination)
+    entries = [entry for entry in manifest['files'] if entry['key'].startswith(prefix)]
+    targets = {}
+    for entry in entries:
+        file_name = os.path.normpath(os.path.join(root, *entry['key'].split('/')))
+        if not file_name.startswith(root + os.sep):
+            raise ValueError('%s would be written outside %s' % (entry['key'], root))
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'wb') as restored:
+            restored.truncate(entry['size'])
+
+        offset = 0
+        for digest, size in entry['chunks']:
+            targets.setdefault(digest, []).append((file_name, offset))
+            offset += size
+        entry['file_name'] = file_name
+
+    progress = BackupProgress('Restored')
+    for entry in entries:
+        progress.found(entry['size'])
+    progress.scanning = False
+    failed = []
+    incomplete = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as fetchers:
+        futures = dict((fetchers.submit(_fetch_chunk, client, bucket_name, digest, chunk_targets), digest)
+                       for digest, chunk_targets in targets.items())
+        for future, digest in futures.items():
+            try:
+                progress.sent(future.result() * len(targets[digest]))
+            except (OSError, ValueError, BotoCoreError, ClientError) as error:
+                print('Failed to restore chunk %s: %s' % (digest, error))
+                failed.append(digest)
+                incomplete.update(file_name for file_name, offset in targets[digest])
+
+    # An incomplete file keeps the mtime of the restore, so nothing that
+    # compares size and mtime takes it for the original.
+    incomplete_keys = []
+    for entry in entries:
+        if entry['file_name'] in incomplete:
+            incomplete_keys.append(entry['key'])
+            continue
+        os.utime(entry['file_name'], ns=(entry['mtime_ns'], entry['mtime_ns']))
+        progress.file_done()
+
+    progress.report()
+    if failed:
+        print('%d chunks failed, %d files are incomplete:' % (len(failed), len(incomplete_keys)))
+        for key in incomplete_keys:
+            print('\t', key)
+    return incomplete_keys
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--name', required=True, help="Bucket name")
+    parser.add_argument('-d', '--dir', '--directory', nargs='*', help="Local files and directories to back up")
+    parser.add_argument('--backup', action='store_true', help="Back up --dir as a deduplicated snapshot")
+    parser.add_argument('--restore', metavar='snapshot', help="Restore a snapshot ('latest' for the newest)")
+    parser.add_argument('--to', default='.', help="Directory to restore into")
+    parser.add_argument('--prefix', default='', help="Only restore files under this path")
+    parser.add_argument('--snapshots', action='store_true', help="List snapshots")
+    parser.add_argument('--refresh-index', action='store_true', help="Rebuild the local chunk index from the bucket first")
+    parser.add_argument('-w', '--workers', type=int, default=DEDUP_WORKERS, help="Concurrent chunk transfers")
+    parser.add_argument('-p', '--processes', type=int, help="Processes scanning for chunk boundaries (default: one per core)")
+    args = parser.parse_args()
+
+    if args.snapshots:
+        for snapshot in list_snapshots(boto3.client('s3'), args.name):
+            print(snapshot)
+
+    if args.backup:
+        if not args.dir:
+            print('Must specify local directory to backup. Exiting.')
+            exit()
+
+        dedup_backup(args.name, args.dir, workers=args.workers, processes=args.processes,
+                     refresh_index=args.refresh_index)
+
+    if args.restore:
+        dedup_restore(args.name, args.to, snapshot=args.restore, prefix=args.prefix, workers=args.workers)
@@ -0,0 +1,251 @@
+#!/usr/local/bin/python3
+
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from s3_sample_code import configure, get_acl, get_client, get_cors, get_lifecycle_configuration, get_policy
+
+# Account-wide bucket inventory. Every bucket's ACL, CORS rules, policy and
+# lifecycle rules are read concurrently with the s3_sample_code getters,
+# each in the bucket's own region, and saved as one snapshot. Each run is compared with
+# the previous snapshot and the differences printed.
+#
+#     ./s3_inventory.py --workers 64
+#     ./s3_inventory.py --format sqlite
+
+INVENTORY_DIR = os.path.expanduser('~/.cache/aws_tools/inventory')
+INVENTORY_DB = os.path.join(INVENTORY_DIR, 'inventory.db')
+INVENTORY_WORKERS = 32
+
+# Errors that just mean the bucket has no such configuration.
+NO_CONFIGURATION_ERRORS = (
+    'NoSuchCORSConfiguration',
+    'NoSuchBucketPolicy',
+    'NoSuchLifecycleConfiguration',
+)
+
+INVENTORY_FIELDS = ('acl', 'cors', 'policy', 'lifecycle')
+
+# Reads that fail (throttling, access denied, a region that couldn't be
+# found) are recorded as {UNKNOWN: reason}. They say nothing about the
+# configuration, so diffs skip them.
+UNKNOWN = 'unknown'
+
+
+def _read_acl(bucket_name, region):
+    acl = get_acl(bucket_name, region)
+    return {'Owner': acl.owner, 'Grants': acl.grants}
+
+
+def _read_cors(bucket_name, region):
+    return get_cors(bucket_name, region).cors_rules
+
+
+READERS = {
+    'acl': _read_acl,
+    'cors': _read_cors,
+    'policy': get_policy,
+    'lifecycle': get_lifecycle_configuration,
+}
+
+
+def bucket_region(bucket_name):
+    location = get_client().get_bucket_location(Bucket=bucket_name)['LocationConstraint']
+    # Buckets in us-east-1 have no location constraint, and the oldest
+    # eu-west-1 buckets report the legacy 'EU'.
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+
+def is_unknown(value):
+    return isinstance(value, dict) and list(value) == [UNKNOWN]
+
+
+def _read_configuration(bucket_name, region, field):
+    """Returns one configuration of a bucket: None if it has none, or {UNKNOWN: reason}."""
+    try:
+        return READERS[field](bucket_name, region)
+    except ClientError as error:
+        code = error.response['Error']['Code']
+        if code in NO_CONFIGURATION_ERRORS:
+            return None
+        return {UNKNOWN: code}
+    except BotoCoreError as error:
+        return {UNKNOWN: str(error)}
+
+
+def take_inventory(workers=INVENTORY_WORKERS):
+    """
+    Returns {'taken': ..., 'buckets': {name: {'region': ..., 'acl': ...}}}
+    for every bucket in the account. Regions are looked up first, then all
+    configuration reads run at once across the pool.
+    """
+    configure(max_pool_connections=workers)
+    bucket_names = [bucket['Name'] for bucket in get_client().list_buckets()['Buckets']]
+    buckets = dict((bucket_name, {}) for bucket_name in bucket_names)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        regions = [(bucket_name, executor.submit(bucket_region, bucket_name)) for bucket_name in bucket_names]
+        reads = []
+        for bucket_name, future in regions:
+            try:
+                region = future.result()
+            except (BotoCoreError, ClientError) as error:
+                print('Failed to find the region of %s: %s' % (bucket_name, error))
+                for field in ('region',) + INVENTORY_FIELDS:
+                    buckets[bucket_name][field] = {UNKNOWN: str(error)}
+                continue
+            buckets[bucket_name]['region'] = region
+            for field in INVENTORY_FIELDS:
+                reads.append((bucket_name, field,
+                              executor.submit(_read_configuration, bucket_name, region, field)))
+
+        for bucket_name, field, future in reads:
+            buckets[bucket_name][field] = future.result()
+
+    unknown = sum(1 for bucket in buckets.values() for field in INVENTORY_FIELDS if is_unknown(bucket[field]))
+    print('Inventoried %d buckets, %d configuration reads, %d unknown.' % (len(buckets), len(reads), unknown))
+    # Round trip through JSON so dates compare the same as in saved snapshots.
+    buckets = json.loads(json.dumps(buckets, default=str))
+    return {'taken': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'buckets': buckets}
+
+
+def save_json(inventory, directory=INVENTORY_DIR):
+    """Writes the inventory as <taken>.json in directory and returns the file name."""
+    os.makedirs(directory, exist_ok=True)
+    file_name = os.path.join(directory, inventory['taken'].replace(':', '') + '.json')
+    with open(file_name + '.tmp', 'w') as snapshot:
+        json.dump(inventory, snapshot, indent=2, sort_keys=True)
+    os.replace(file_name + '.tmp', file_name)
+    return file_name
+
+
+def load_latest_json(directory=INVENTORY_DIR):
+    """Returns the newest JSON inventory in directory, or None."""
+    if not os.path.isdir(directory):
+        return None
+    snapshots = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    if not snapshots:
+        return None
+    with open(os.path.join(directory, snapshots[-1])) as snapshot:
+        return json.load(snapshot)
+
+
+def _open_db(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS buckets ('
+        ' taken TEXT,'
+        ' name TEXT,'
+        ' region TEXT,'
+        ' acl TEXT,'
+        ' cors TEXT,'
+        ' policy TEXT,'
+        ' lifecycle TEXT,'
+        ' PRIMARY KEY (taken, name)'
+        ')')
+    conn.execute('CREATE TABLE IF NOT EXISTS snapshots (taken TEXT PRIMARY KEY)')
+    return conn
+
+
+def save_sqlite(inventory, path=INVENTORY_DB):
+    """Adds the inventory to the SQLite history in path and returns path."""
+    conn = _open_db(path)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?)', (inventory['taken'],))
+        for bucket_name, bucket in inventory['buckets'].items():
+            # Regions are plain text; an unknown one is stored as NULL.
+            region = bucket.get('region')
+            if is_unknown(region):
+                region = None
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (inventory['taken'], bucket_name, region)
+                + tuple(json.dumps(bucket.get(field), sort_keys=True) for field in INVENTORY_FIELDS))
+    conn.close()
+    return path
+
+
+def load_latest_sqlite(path=INVENTORY_DB):
+    """Returns the newest inventory in the SQLite history in path, or None."""
+    if not os.path.isfile(path):
+        return None
+    conn = _open_db(path)
+    row = conn.execute('SELECT MAX(taken) FROM snapshots').fetchone()
+    if row[0] is None:
+        conn.close()
+        return None
+
+    buckets = {}
+    cursor = conn.execute('SELECT name, region, {} FROM buckets WHERE taken = ?'.format(
+        ', '.join(INVENTORY_FIELDS)), (row[0],))
+    for name, region, *fields in cursor:
+        buckets[name] = dict(zip(INVENTORY_FIELDS, (json.loads(field) for field in fields)))
+        buckets[name]['region'] = {UNKNOWN: 'region'} if region is None else region
+    conn.close()
+    return {'taken': row[0], 'buckets': buckets}
+
+
+def diff_inventories(old, new):
+    """
+    Returns human-readable lines describing what changed between two
+    inventories. Fields unknown in either one are skipped.
+    """
+    changes = []
+    old_buckets = old['buckets']
+    new_buckets = new['buckets']
+
+    for bucket_name in sorted(set(old_buckets) | set(new_buckets)):
+        if bucket_name not in new_buckets:
+            changes.append('- %s' % bucket_name)
+        elif bucket_name not in old_buckets:
+            region = new_buckets[bucket_name].get('region')
+            changes.append('+ %s (%s)' % (bucket_name, UNKNOWN if is_unknown(region) else region))
+        else:
+            for field in ('region',) + INVENTORY_FIELDS:
+                before = old_buckets[bucket_name].get(field)
+                after = new_buckets[bucket_name].get(field)
+                if is_unknown(before) or is_unknown(after):
+                    continue
+                if before != after:
+                    changes.append('~ %s %s: %s -> %s' % (
+                        bucket_name, field, json.dumps(before, sort_keys=True), json.dumps(after, sort_keys=True)))
+    return changes
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', choices=('json', 'sqlite'), default='json', help="Snapshot format")
+    parser.add_argument('--path', help="Snapshot directory (json) or database file (sqlite)")
+    parser.add_argument('-w', '--workers', type=int, default=INVENTORY_WORKERS, help="Concurrent configuration reads")
+    args = parser.parse_args()
+
+    if args.format == 'json':
+        path = args.path or INVENTORY_DIR
+        previous = load_latest_json(path)
+    else:
+        path = args.path or INVENTORY_DB
+        previous = load_latest_sqlite(path)
+
+    inventory = take_inventory(workers=args.workers)
+
+    if args.format == 'json':
+        print('Snapshot written to', save_json(inventory, path))
+    else:
+        print('Snapshot added to', save_sqlite(inventory, path))
+
+    if previous:
+        changes = diff_inventories(previous, inventory)
+        print('%d changes since %s' % (len(changes), previous['taken']))
+        for change in changes:
+            print(change)
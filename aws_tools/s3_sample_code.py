@@ -23,23 +23,101 @@ Additional information
 
 import json
 import logging
+import os
+import threading
 import uuid
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
-s3_resource = boto3.resource('s3')
+# Connections each client keeps open. Size it to at least the number of
+# threads sharing a client.
+DEFAULT_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+
+# Clients and resources are created lazily from one shared session: one
+# thread-safe client per Region, and one resource per Region per thread,
+# since resources aren't thread-safe.
+_lock = threading.Lock()
+_thread_state = threading.local()
+_max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+# Bumped by configure, so threads rebuild their resources.
+_generation = 0
+_session = None
+_clients = {}
+
+
+def configure(max_pool_connections=None):
+    """
+    Set the connection pool size of the S3 clients and resources. Clients
+    already created are dropped, so the next calls build them with the new
+    size.
+
+    :param max_pool_connections: The number of connections each client keeps open.
+    """
+    global _max_pool_connections, _generation
+    with _lock:
+        if max_pool_connections:
+            _max_pool_connections = max_pool_connections
+            _generation += 1
+            _clients.clear()
+
+
+def _config():
+    return Config(max_pool_connections=_max_pool_connections)
+
+
+def _get_session():
+    """Get the shared session. Call with _lock held; sessions aren't thread-safe."""
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def _region_key(region):
+    with _lock:
+        return region or _get_session().region_name
+
+
+def get_client(region=None):
+    """
+    Get the shared S3 client for a Region, or for your default Region.
+    Clients are thread-safe, so every thread gets the same one.
+
+    :param region: The Region the client sends requests to.
+    :return: The S3 client.
+    """
+    region = _region_key(region)
+    with _lock:
+        client = _clients.get(region)
+        if client is None:
+            client = _get_session().client('s3', region_name=region, config=_config())
+            _clients[region] = client
+    return client
 
 
 def get_s3(region=None):
-    """Get a Boto 3 S3 resource with a specific Region or with your default Region."""
-    global s3_resource
-    if not region or s3_resource.meta.client.meta.region_name == region:
-        return s3_resource
-    else:
-        return boto3.resource('s3', region_name=region)
+    """
+    Get the calling thread's Boto 3 S3 resource for a specific Region or for
+    your default Region.
+
+    :param region: The Region the resource sends requests to.
+    :return: The S3 resource.
+    """
+    region = _region_key(region)
+    if getattr(_thread_state, 'generation', None) != _generation:
+        _thread_state.generation = _generation
+        _thread_state.resources = {}
+    resources = _thread_state.resources
+    s3 = resources.get(region)
+    if s3 is None:
+        with _lock:
+            s3 = _get_session().resource('s3', region_name=region, config=_config())
+        resources[region] = s3
+    return s3
 
 
 def create_bucket(name, region=None):
@@ -95,9 +173,8 @@ def bucket_exists(bucket_name):
     :param bucket_name: The name of the bucket to check.
     :return: True when the bucket exists; otherwise, False.
     """
-    s3 = get_s3()
     try:
-        s3.meta.client.head_bucket(Bucket=bucket_name)
+        get_client().head_bucket(Bucket=bucket_name)
         logger.info("Bucket %s exists.", bucket_name)
         exists = True
     except ClientError:
@@ -179,20 +256,22 @@ def grant_log_delivery_access(bucket_name):
         raise
 
 
-def get_acl(bucket_name):
+def get_acl(bucket_name, region=None):
     """
     Get the ACL of the specified bucket.
 
     Usage is shown in usage_demo at the end of this module.
 
     :param bucket_name: The name of the bucket to retrieve.
+    :param region: The Region the request is sent to, or None for your default Region.
     :return: The ACL of the bucket.
     """
-    s3 = get_s3()
+    s3 = get_s3(region)
     try:
         acl = s3.Bucket(bucket_name).Acl()
+        # S3 no longer returns display names in most Regions.
         logger.info("Got ACL for bucket %s owned by %s.",
-                    bucket_name, acl.owner['DisplayName'])
+                    bucket_name, acl.owner.get('DisplayName', acl.owner['ID']))
     except ClientError:
         logger.exception("Couldn't get ACL for bucket %s.", bucket_name)
         raise
@@ -221,21 +300,25 @@ def put_cors(bucket_name, cors_rules):
         raise
 
 
-def get_cors(bucket_name):
+def get_cors(bucket_name, region=None):
     """
     Get the CORS rules for the specified bucket.
 
     Usage is shown in usage_demo at the end of this module.
 
     :param bucket_name: The name of the bucket to check.
+    :param region: The Region the request is sent to, or None for your default Region.
     :return The CORS rules for the specified bucket.
     """
-    s3 = get_s3()
+    s3 = get_s3(region)
     try:
         cors = s3.Bucket(bucket_name).Cors()
         logger.info("Got CORS rules %s for bucket '%s'.", cors.cors_rules, bucket_name)
-    except ClientError:
-        logger.exception(("Couldn't get CORS for bucket %s.", bucket_name))
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchCORSConfiguration':
+            logger.info("Bucket '%s' has no CORS rules.", bucket_name)
+        else:
+            logger.exception("Couldn't get CORS for bucket %s.", bucket_name)
         raise
     else:
         return cors
@@ -278,21 +361,25 @@ def put_policy(bucket_name, policy):
         raise
 
 
-def get_policy(bucket_name):
+def get_policy(bucket_name, region=None):
     """
     Get the security policy of a bucket.
 
     Usage is shown in usage_demo at the end of this module.
 
     :param bucket_name: The bucket to retrieve.
+    :param region: The Region the request is sent to, or None for your default Region.
     :return: The security policy of the specified bucket.
     """
-    s3 = get_s3()
+    s3 = get_s3(region)
     try:
         policy = s3.Bucket(bucket_name).Policy()
         logger.info("Got policy %s for bucket '%s'.", policy.policy, bucket_name)
-    except ClientError:
-        logger.exception("Couldn't get policy for bucket '%s'.", bucket_name)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchBucketPolicy':
+            logger.info("Bucket '%s' has no policy.", bucket_name)
+        else:
+            logger.exception("Couldn't get policy for bucket '%s'.", bucket_name)
         raise
     else:
         return json.loads(policy.policy)
@@ -340,23 +427,27 @@ def put_lifecycle_configuration(bucket_name, lifecycle_rules):
         raise
 
 
-def get_lifecycle_configuration(bucket_name):
+def get_lifecycle_configuration(bucket_name, region=None):
     """
     Get the lifecycle configuration of the specified bucket.
 
     Usage is shown in usage_demo at the end of this module.
 
     :param bucket_name: The name of the bucket to retrieve.
+    :param region: The Region the request is sent to, or None for your default Region.
     :return: The lifecycle rules of the specified bucket.
     """
-    s3 = get_s3()
+    s3 = get_s3(region)
     try:
         config = s3.Bucket(bucket_name).LifecycleConfiguration()
         logger.info("Got lifecycle rules %s for bucket '%s'.",
                     config.rules, bucket_name)
-    except:
-        logger.exception("Couldn't get lifecycle configuration for bucket '%s'.",
-                         bucket_name)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchLifecycleConfiguration':
+            logger.info("Bucket '%s' has no lifecycle configuration.", bucket_name)
+        else:
+            logger.exception("Couldn't get lifecycle configuration for bucket '%s'.",
+                             bucket_name)
         raise
     else:
         return config.rules
@@ -394,9 +485,8 @@ def generate_presigned_post(bucket_name, object_key, expires_in):
     :return: A dictionary that contains the URL and form fields that contain
              required access data.
     """
-    s3 = get_s3()
     try:
-        response = s3.meta.client.generate_presigned_post(
+        response = get_client().generate_presigned_post(
             Bucket=bucket_name, Key=object_key, ExpiresIn=expires_in)
         logger.info("Got presigned POST URL: %s", response['url'])
     except ClientError:
@@ -411,7 +501,7 @@ def usage_demo():
     prefix = 'usage-demo-bucket-wrapper-'
 
     created_buckets = [create_bucket(prefix + str(uuid.uuid1()),
-                                     s3_resource.meta.client.meta.region_name)
+                                     get_client().meta.region_name)
                        for _ in range(3)]
     for bucket in created_buckets:
         print(f"Created bucket {bucket.name}.")
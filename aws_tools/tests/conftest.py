@@ -0,0 +1,44 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# The tools are scripts rather than a package, and aws_s3_test makes its
+# clients at import, so credentials and a region have to be set first.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+os.environ.pop('AWS_PROFILE', None)
+
+BUCKET = 'backup-test'
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    """A moto S3 client with an empty bucket, and manifests and chunk indexes kept in tmp_path."""
+    import aws_s3_test
+    import s3_dedup
+    monkeypatch.setattr(aws_s3_test, 'MANIFEST_DIR', str(tmp_path / 'manifests'))
+    monkeypatch.setattr(s3_dedup, 'CHUNK_INDEX_DIR', str(tmp_path / 'chunks'))
+
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def write_files(root, files):
+    """Writes {relative path: bytes} under root."""
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def bucket_keys(client, prefix=''):
+    paginator = client.get_paginator('list_objects_v2')
+    return sorted(obj['Key'] for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix)
+                  for obj in page.get('Contents', []))
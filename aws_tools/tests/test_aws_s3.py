@@ -0,0 +1,140 @@
+import os
+import shutil
+
+import pytest
+
+import aws_s3_test
+from conftest import BUCKET, bucket_keys, write_files
+
+
+class FlakyDeletes:
+    """Wraps a client so DeleteObjects reports errors for some keys the first time they are sent."""
+
+    def __init__(self, client, errors):
+        self.client = client
+        self.errors = dict(errors)
+        self.batches = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def delete_objects(self, Bucket, Delete):
+        refs = Delete['Objects']
+        self.batches.append([ref['Key'] for ref in refs])
+        failing = [ref for ref in refs if ref['Key'] in self.errors]
+        refs = [ref for ref in refs if ref['Key'] not in self.errors]
+        response = self.client.delete_objects(Bucket=Bucket, Delete=dict(Delete, Objects=refs)) if refs else {}
+        response['Errors'] = response.get('Errors', []) + [
+            {'Key': ref['Key'], 'Code': self.errors.pop(ref['Key']), 'Message': 'injected'}
+            for ref in failing]
+        return response
+
+
+def put_objects(client, count, prefix='obj/'):
+    keys = ['%s%04d' % (prefix, i) for i in range(count)]
+    for key in keys:
+        client.put_object(Bucket=BUCKET, Key=key, Body=b'x')
+    return keys
+
+
+def test_bulk_delete_batches(s3, monkeypatch):
+    monkeypatch.setattr(aws_s3_test, 'DELETE_BATCH_SIZE', 10)
+    keys = put_objects(s3, 25)
+    client = FlakyDeletes(s3, {})
+
+    failed = aws_s3_test.bulk_delete(BUCKET, ({'Key': key} for key in keys), workers=2, client=client)
+
+    assert failed == []
+    assert sorted(len(batch) for batch in client.batches) == [5, 10, 10]
+    assert bucket_keys(s3) == []
+
+
+def test_bulk_delete_retries_transient_errors(s3, monkeypatch):
+    monkeypatch.setattr(aws_s3_test.time, 'sleep', lambda seconds: None)
+    keys = put_objects(s3, 6)
+    client = FlakyDeletes(s3, {keys[1]: 'SlowDown', keys[2]: 'InternalError', keys[4]: 'AccessDenied'})
+
+    failed = aws_s3_test.bulk_delete(BUCKET, ({'Key': key} for key in keys), workers=1, client=client)
+
+    assert failed == [{'Key': keys[4]}]
+    assert client.batches[1] == [keys[1], keys[2]]
+    assert bucket_keys(s3) == [keys[4]]
+
+
+def test_empty_and_delete_versioned_bucket(s3):
+    s3.put_bucket_versioning(Bucket=BUCKET, VersioningConfiguration={'Status': 'Enabled'})
+    keys = put_objects(s3, 5)
+    put_objects(s3, 5)
+    s3.delete_object(Bucket=BUCKET, Key=keys[0])
+
+    assert aws_s3_test.empty_and_delete_bucket(BUCKET, workers=2)
+    assert BUCKET not in [bucket['Name'] for bucket in s3.list_buckets()['Buckets']]
+
+
+def test_incremental_backup_deletes_removed_files(s3, tmp_path):
+    source = tmp_path / 'source'
+    write_files(source, {'a': b'a', 'sub/b': b'b', 'sub/c': b'c'})
+    manifest = str(tmp_path / 'manifest.db')
+
+    assert aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, manifest_file=manifest) == []
+    assert bucket_keys(s3) == ['a', 'sub/b', 'sub/c']
+
+    os.remove(source / 'sub' / 'b')
+    aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, delete=True, manifest_file=manifest)
+    assert bucket_keys(s3) == ['a', 'sub/c']
+
+
+def test_incremental_backup_keeps_objects_it_could_not_scan(s3, tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    write_files(source, {'a': b'a', 'sub/b': b'b', 'sub/deep/c': b'c'})
+    manifest = str(tmp_path / 'manifest.db')
+    aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, manifest_file=manifest)
+
+    scandir = os.scandir
+
+    def unreadable_sub(path):
+        if os.path.basename(path) == 'sub':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(aws_s3_test.os, 'scandir', unreadable_sub)
+    aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, delete=True, manifest_file=manifest)
+    monkeypatch.undo()
+    assert bucket_keys(s3) == ['a', 'sub/b', 'sub/deep/c']
+
+    shutil.rmtree(source)
+    with pytest.raises(OSError):
+        aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, delete=True,
+                           manifest_file=manifest)
+    assert bucket_keys(s3) == ['a', 'sub/b', 'sub/deep/c']
+
+
+def test_pack_backup_restores(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(aws_s3_test, 'PACK_FILE_THRESHOLD', 1024)
+    files = dict(('small/%d' % i, b'small file %d' % i) for i in range(20))
+    files['large'] = os.urandom(4096)
+    source = tmp_path / 'source'
+    write_files(source, files)
+    manifest = str(tmp_path / 'manifest.db')
+
+    assert aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, pack=True,
+                              manifest_file=manifest) == []
+    keys = bucket_keys(s3)
+    assert [key for key in keys if not key.startswith(aws_s3_test.PACK_PREFIX)] == ['large']
+    assert len([key for key in keys if key.endswith('.pack')]) == 1
+
+    os.remove(source / 'small' / '3')
+    del files['small/3']
+    aws_s3_test.backup(BUCKET, [str(source)], workers=2, incremental=True, delete=True, pack=True,
+                       manifest_file=manifest)
+
+    destination = tmp_path / 'restored'
+    assert aws_s3_test.restore(BUCKET, str(destination), workers=2) == []
+    restored = dict((path.relative_to(destination).as_posix(), path.read_bytes())
+                    for path in destination.rglob('*') if path.is_file())
+    assert restored == files
+
+    prefixed = tmp_path / 'prefixed'
+    assert aws_s3_test.restore(BUCKET, str(prefixed), prefix='small/1', workers=2) == []
+    assert sorted(path.name for path in (prefixed / 'small').iterdir()) == ['1', '10', '11', '12', '13', '14',
+                                                                            '15', '16', '17', '18', '19']
@@ -0,0 +1,70 @@
+import os
+import random
+
+import pytest
+
+import s3_dedup
+from conftest import BUCKET, bucket_keys, write_files
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+def restored_files(root):
+    return dict((path.relative_to(root).as_posix(), path.read_bytes())
+                for path in root.rglob('*') if path.is_file())
+
+
+@pytest.mark.skipif(s3_dedup.numpy is None, reason='numpy is not installed')
+def test_numpy_cut_candidates_match_python(tmp_path, monkeypatch):
+    file_name = tmp_path / 'data'
+    file_name.write_bytes(random_bytes(3 * 1024 * 1024, 1) + bytes(256 * 1024))
+    start, end = 1000, 3 * 1024 * 1024 + 100000
+
+    fast = s3_dedup._cut_candidates(str(file_name), start, end)
+    monkeypatch.setattr(s3_dedup, 'numpy', None)
+    assert fast == s3_dedup._cut_candidates(str(file_name), start, end)
+
+
+def test_dedup_backup_and_restore(s3, tmp_path):
+    big = random_bytes(6 * 1024 * 1024, 2)
+    files = {'big': big, 'copy/big': big, 'small': b'small file', 'empty': b''}
+    source = tmp_path / 'source'
+    write_files(source, files)
+
+    assert s3_dedup.dedup_backup(BUCKET, [str(source)], workers=4, processes=1)
+    chunks = bucket_keys(s3, s3_dedup.CHUNK_PREFIX)
+
+    # Only the chunks around an edit are uploaded again.
+    edited = big[:3 * 1024 * 1024] + b'edit' + big[3 * 1024 * 1024:]
+    files['big'] = edited
+    write_files(source, {'big': edited})
+    assert s3_dedup.dedup_backup(BUCKET, [str(source)], workers=4, processes=1)
+    new_chunks = set(bucket_keys(s3, s3_dedup.CHUNK_PREFIX)) - set(chunks)
+    assert 0 < len(new_chunks) <= 2
+
+    destination = tmp_path / 'restored'
+    assert s3_dedup.dedup_restore(BUCKET, str(destination), workers=4) == []
+    assert restored_files(destination) == files
+    assert os.stat(destination / 'small').st_mtime_ns == os.stat(source / 'small').st_mtime_ns
+
+    prefixed = tmp_path / 'prefixed'
+    assert s3_dedup.dedup_restore(BUCKET, str(prefixed), prefix='copy/', workers=4) == []
+    assert restored_files(prefixed) == {'copy/big': big}
+
+
+def test_dedup_restore_reports_corrupt_chunks(s3, tmp_path):
+    source = tmp_path / 'source'
+    write_files(source, {'big': random_bytes(3 * 1024 * 1024, 3), 'small': b'small file'})
+    assert s3_dedup.dedup_backup(BUCKET, [str(source)], workers=4, processes=1)
+
+    large_chunk = max(s3.list_objects_v2(Bucket=BUCKET, Prefix=s3_dedup.CHUNK_PREFIX)['Contents'],
+                      key=lambda obj: obj['Size'])
+    s3.put_object(Bucket=BUCKET, Key=large_chunk['Key'], Body=b'corrupt')
+
+    destination = tmp_path / 'restored'
+    assert s3_dedup.dedup_restore(BUCKET, str(destination), workers=4) == ['big']
+    assert (destination / 'small').read_bytes() == b'small file'
+    assert os.stat(destination / 'small').st_mtime_ns == os.stat(source / 'small').st_mtime_ns
+    assert os.stat(destination / 'big').st_mtime_ns != os.stat(source / 'big').st_mtime_ns
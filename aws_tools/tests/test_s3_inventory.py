@@ -0,0 +1,63 @@
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+
+import s3_inventory
+from conftest import BUCKET
+
+CORS_RULES = [{'AllowedMethods': ['GET'], 'AllowedOrigins': ['*']}]
+LIFECYCLE_RULES = [{'ID': 'expire', 'Filter': {'Prefix': 'tmp/'}, 'Status': 'Enabled', 'Expiration': {'Days': 7}}]
+
+
+def bucket_policy(bucket_name, action):
+    return {
+        'Version': '2012-10-17',
+        'Statement': [{
+            'Effect': 'Allow',
+            'Principal': '*',
+            'Action': action,
+            'Resource': 'arn:aws:s3:::%s/*' % bucket_name,
+        }],
+    }
+
+
+def test_inventory_reads_and_diffs(s3, tmp_path, monkeypatch):
+    eu_client = boto3.client('s3', region_name='eu-west-2')
+    eu_client.create_bucket(Bucket='backup-test-eu', CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    eu_client.put_bucket_cors(Bucket='backup-test-eu', CORSConfiguration={'CORSRules': CORS_RULES})
+    eu_client.put_bucket_lifecycle_configuration(
+        Bucket='backup-test-eu', LifecycleConfiguration={'Rules': LIFECYCLE_RULES})
+    s3.put_bucket_policy(Bucket=BUCKET, Policy=json.dumps(bucket_policy(BUCKET, 's3:GetObject')))
+
+    first = s3_inventory.take_inventory(workers=4)
+    eu_bucket = first['buckets']['backup-test-eu']
+    assert eu_bucket['region'] == 'eu-west-2'
+    assert eu_bucket['cors'][0]['AllowedOrigins'] == ['*']
+    assert eu_bucket['lifecycle'][0]['ID'] == 'expire'
+    assert eu_bucket['policy'] is None
+    bucket = first['buckets'][BUCKET]
+    assert bucket['region'] == 'us-east-1'
+    assert bucket['policy'] == bucket_policy(BUCKET, 's3:GetObject')
+    assert bucket['cors'] is None and bucket['lifecycle'] is None
+    assert bucket['acl']['Grants']
+
+    s3.put_bucket_policy(Bucket=BUCKET, Policy=json.dumps(bucket_policy(BUCKET, 's3:PutObject')))
+
+    # A failed read is unknown, and left out of the diff rather than reported as removed.
+    def throttled(bucket_name, region):
+        raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'injected'}}, 'GetBucketCors')
+
+    monkeypatch.setitem(s3_inventory.READERS, 'cors', throttled)
+    second = s3_inventory.take_inventory(workers=4)
+    assert s3_inventory.is_unknown(second['buckets']['backup-test-eu']['cors'])
+
+    changes = s3_inventory.diff_inventories(first, second)
+    assert len(changes) == 1 and changes[0].startswith('~ %s policy:' % BUCKET)
+
+    path = str(tmp_path / 'inventory.db')
+    s3_inventory.save_sqlite(second, path)
+    assert s3_inventory.diff_inventories(second, s3_inventory.load_latest_sqlite(path)) == []
+
+    s3_inventory.save_json(second, str(tmp_path))
+    assert s3_inventory.load_latest_json(str(tmp_path)) == second
@@ -1,9 +1,49 @@
 #!/usr/local/bin/python3
 
+import bisect
+import csv
+import json
 import os
-import google.cloud
-from google.oauth2 import service_account
-from google.cloud import storage
+import queue
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from google.api_core import exceptions
+
+import gs_index
+from gs_client import DEFAULT_POOL_SIZE, configure, get_client
+from gs_objects import (DEFAULT_WORKERS, DELETE_BATCH_SIZE, Progress, bounded_map, delete_blobs,
+                        parse_size, rewrite_blob)
+
+CHECKPOINT_DIR = os.path.expanduser('~/.cache/gcp_tools/migrate')
+
+# Listing pages (of up to 1000 blobs) each shard may buffer ahead of the
+# consumer. This bounds memory however big the bucket is.
+SHARD_PAGES_AHEAD = 4
+
+# Blob fields that can be projected in listings, keyed by JSON API name.
+LIST_FIELDS = {
+    'name': lambda blob: blob.name,
+    'size': lambda blob: blob.size,
+    'crc32c': lambda blob: blob.crc32c,
+    'md5Hash': lambda blob: blob.md5_hash,
+    'generation': lambda blob: blob.generation,
+    'storageClass': lambda blob: blob.storage_class,
+    'contentType': lambda blob: blob.content_type,
+    'timeCreated': lambda blob: blob.time_created.isoformat() if blob.time_created else None,
+    'updated': lambda blob: blob.updated.isoformat() if blob.updated else None,
+}
+DEFAULT_LIST_FIELDS = ('name', 'size', 'crc32c', 'updated')
+
+# Upper bounds (exclusive) of the size and age histograms in usage reports.
+USAGE_SIZE_BINS = ((1 << 10, '<1K'), (1 << 20, '<1M'), (16 << 20, '<16M'),
+                   (128 << 20, '<128M'), (1 << 30, '<1G'), (16 << 30, '<16G'))
+USAGE_AGE_BINS = ((1, '<1d'), (7, '<7d'), (30, '<30d'), (90, '<90d'), (365, '<1y'))
 
 # If you don't specify credentials when constructing the client, the
 # client library will look for credentials in the environment.
@@ -16,7 +56,7 @@ def create_bucket_class_location(bucket_name):
     """
     # bucket_name = "your-new-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
 
     bucket = storage_client.bucket(bucket_name)
     bucket.storage_class = "COLDLINE"
@@ -30,96 +70,425 @@ def create_bucket_class_location(bucket_name):
     return new_bucket
 
 def list_buckets():
-    storage_client = storage.Client()
+    storage_client = get_client()
     buckets = list(storage_client.list_buckets())
     print(buckets)
 
 
+# The bucket properties reported by bucket_metadata, in display order.
+BUCKET_FIELDS = (
+    ('ID', lambda bucket: bucket.id),
+    ('Name', lambda bucket: bucket.name),
+    ('Storage Class', lambda bucket: bucket.storage_class),
+    ('Location', lambda bucket: bucket.location),
+    ('Location Type', lambda bucket: bucket.location_type),
+    ('Cors', lambda bucket: bucket.cors),
+    ('Default Event Based Hold', lambda bucket: bucket.default_event_based_hold),
+    ('Default KMS Key Name', lambda bucket: bucket.default_kms_key_name),
+    ('Metageneration', lambda bucket: bucket.metageneration),
+    ('Public Access Prevention', lambda bucket: bucket.iam_configuration.public_access_prevention),
+    ('Retention Effective Time', lambda bucket: bucket.retention_policy_effective_time),
+    ('Retention Period', lambda bucket: bucket.retention_period),
+    ('Retention Policy Locked', lambda bucket: bucket.retention_policy_locked),
+    ('Requester Pays', lambda bucket: bucket.requester_pays),
+    ('Self Link', lambda bucket: bucket.self_link),
+    ('Time Created', lambda bucket: bucket.time_created),
+    ('Versioning Enabled', lambda bucket: bucket.versioning_enabled),
+    ('Labels', lambda bucket: bucket.labels),
+)
+
+METADATA_CACHE = os.path.expanduser('~/.cache/gcp_tools/bucket_metadata.json')
+METADATA_TTL = 3600
+
+
+def _bucket_info(bucket):
+    """Returns the bucket's reported properties as a JSON friendly dict."""
+    info = {}
+    for label, getter in BUCKET_FIELDS:
+        value = getter(bucket)
+        if not isinstance(value, (str, int, float, bool, list, dict, type(None))):
+            value = str(value)
+        info[label] = value
+    return info
+
+
 def bucket_metadata(bucket_name):
     """Prints out a bucket's metadata."""
     # bucket_name = 'your-bucket-name'
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     bucket = storage_client.get_bucket(bucket_name)
 
     print("")
-    print(f"\tID: {bucket.id}")
-    print(f"\tName: {bucket.name}")
-    print(f"\tStorage Class: {bucket.storage_class}")
-    print(f"\tLocation: {bucket.location}")
-    print(f"\tLocation Type: {bucket.location_type}")
-    print(f"\tCors: {bucket.cors}")
-    print(f"\tDefault Event Based Hold: {bucket.default_event_based_hold}")
-    print(f"\tDefault KMS Key Name: {bucket.default_kms_key_name}")
-    print(f"\tMetageneration: {bucket.metageneration}")
-    print(
-        f"\tPublic Access Prevention: {bucket.iam_configuration.public_access_prevention}"
-    )
-    print(f"\tRetention Effective Time: {bucket.retention_policy_effective_time}")
-    print(f"\tRetention Period: {bucket.retention_period}")
-    print(f"\tRetention Policy Locked: {bucket.retention_policy_locked}")
-    print(f"\tRequester Pays: {bucket.requester_pays}")
-    print(f"\tSelf Link: {bucket.self_link}")
-    print(f"\tTime Created: {bucket.time_created}")
-    print(f"\tVersioning Enabled: {bucket.versioning_enabled}")
-    print(f"\tLabels: {bucket.labels}")
+    for label, value in _bucket_info(bucket).items():
+        print(f"\t{label}: {value}")
     print("")
 
-def list_blobs(bucket_name):
-    """Lists all the blobs in the bucket."""
+
+def _load_metadata_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as cache_file:
+        try:
+            return json.load(cache_file)
+        except ValueError:
+            return {}
+
+
+def _save_metadata_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(path + '.tmp', path)
+
+
+def buckets_metadata(bucket_names=None, output_format='json', ttl=METADATA_TTL,
+                     workers=DEFAULT_WORKERS, cache_path=METADATA_CACHE):
+    """
+    Prints the metadata of many buckets as JSON or CSV. Without bucket names
+    every bucket in the project is reported, which takes a single listing
+    call. Named buckets are fetched concurrently, and results are cached:
+    entries younger than ttl seconds are used as they are, and older ones
+    are revalidated with a metageneration check that costs no payload when
+    the bucket hasn't changed.
+    """
+    # bucket_names = ["your-bucket-name", "your-other-bucket-name"]
+
+    cache = _load_metadata_cache(cache_path)
+    now = time.time()
+
+    if not bucket_names:
+        # Bucket listings already carry the full resource of each bucket.
+        bucket_names = []
+        for bucket in get_client().list_buckets():
+            info = _bucket_info(bucket)
+            cache[bucket.name] = {'fetched': now, 'info': info}
+            bucket_names.append(bucket.name)
+
+    def fetch(bucket_name):
+        cached = cache.get(bucket_name)
+        if cached and now - cached['fetched'] < ttl:
+            return cached
+        try:
+            if cached:
+                bucket = get_client().get_bucket(
+                    bucket_name, if_metageneration_not_match=cached['info']['Metageneration'])
+            else:
+                bucket = get_client().get_bucket(bucket_name)
+        except exceptions.NotModified:
+            return {'fetched': time.time(), 'info': cached['info']}
+        return {'fetched': time.time(), 'info': _bucket_info(bucket)}
+
+    for bucket_name, future in bounded_map(fetch, bucket_names, workers):
+        try:
+            cache[bucket_name] = future.result()
+        except exceptions.GoogleAPICallError as error:
+            print('Failed to get metadata for {}: {}'.format(bucket_name, error), file=sys.stderr)
+
+    _save_metadata_cache(cache_path, cache)
+
+    rows = [cache[bucket_name]['info'] for bucket_name in bucket_names if bucket_name in cache]
+
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=[label for label, getter in BUCKET_FIELDS])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({label: json.dumps(value) if isinstance(value, (list, dict)) else value
+                             for label, value in row.items()})
+    else:
+        print(json.dumps(rows, indent=2))
+
+    return rows
+
+
+def _shard_boundaries(storage_client, bucket_name, prefix, target, max_depth=3):
+    """
+    Finds split points for listing a bucket in parallel by walking delimiter
+    listings, one "directory" level at a time, until there are at least
+    target of them. Any sorted set of split points partitions the name
+    space, so prefixes from different levels can be mixed freely.
+    """
+    boundaries = set()
+    level = [prefix or '']
+
+    for depth in range(max_depth):
+        found = []
+        for level_prefix in level:
+            blobs = storage_client.list_blobs(
+                bucket_name, prefix=level_prefix, delimiter='/', fields='prefixes,nextPageToken')
+            for page in blobs.pages:
+                found.extend(page.prefixes)
+        boundaries.update(found)
+        if not found or len(boundaries) >= target:
+            break
+        level = found
+
+    boundaries = sorted(boundaries)
+    # Too many tiny shards cost more in requests than they save.
+    step = max(1, len(boundaries) // (target * 4))
+    return boundaries[::step]
+
+
+def _put_unless_stopped(pages, item, stop):
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def iter_blobs_sharded(bucket_name, prefix=None, workers=DEFAULT_WORKERS, fields=DEFAULT_LIST_FIELDS):
+    """
+    Streams the bucket's blobs in name order, listing several shards of the
+    name space at once. Only the requested fields are fetched, and each
+    shard buffers at most a few pages ahead of the consumer.
+    """
     # bucket_name = "your-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
+    boundaries = _shard_boundaries(storage_client, bucket_name, prefix, workers * 4)
+    shards = iter(zip([None] + boundaries, boundaries + [None]))
+    item_fields = 'items({}),nextPageToken'.format(','.join(fields))
+    stop = threading.Event()
+
+    def list_shard(start_offset, end_offset, pages):
+        try:
+            blobs = get_client().list_blobs(
+                bucket_name, prefix=prefix, start_offset=start_offset,
+                end_offset=end_offset, fields=item_fields)
+            for page in blobs.pages:
+                if not _put_unless_stopped(pages, list(page), stop):
+                    return
+        finally:
+            _put_unless_stopped(pages, None, stop)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = deque()
+
+        def start_next_shard():
+            shard = next(shards, None)
+            if shard is not None:
+                pages = queue.Queue(maxsize=SHARD_PAGES_AHEAD)
+                running.append((pages, executor.submit(list_shard, shard[0], shard[1], pages)))
+
+        for _ in range(workers):
+            start_next_shard()
+
+        # Shards are drained in order, which keeps the merged output sorted;
+        # the ones behind the head keep listing into their buffers meanwhile.
+        try:
+            while running:
+                pages, future = running.popleft()
+                for page in iter(pages.get, None):
+                    yield from page
+                future.result()
+                start_next_shard()
+        finally:
+            stop.set()
+
+
+def list_blobs(bucket_name, prefix=None, workers=DEFAULT_WORKERS, json_lines=False,
+               fields=DEFAULT_LIST_FIELDS, from_index=False, min_size=None):
+    """
+    Lists all the blobs in the bucket. With json_lines set, each blob is
+    printed as a JSON object holding the requested fields. With from_index
+    set, the answer comes from the local index instead of the API, and can
+    be narrowed to blobs of at least min_size bytes.
+    """
+    # bucket_name = "your-bucket-name"
+
+    if not json_lines:
+        fields = ('name',)
+
+    if from_index:
+        conn = gs_index.open_index(bucket_name)
+        for row in gs_index.query(conn, prefix=prefix, min_size=min_size):
+            if json_lines:
+                print(json.dumps({field: row.get(field) for field in fields}))
+            else:
+                print(row['name'])
+        conn.close()
+        return
+
+    listed = fields
+    if min_size is not None and 'size' not in fields:
+        listed = fields + ('size',)
+
+    for blob in iter_blobs_sharded(bucket_name, prefix=prefix, workers=workers, fields=listed):
+        if min_size is not None and blob.size < min_size:
+            continue
+        if json_lines:
+            print(json.dumps({field: LIST_FIELDS[field](blob) for field in fields}))
+        else:
+            print(blob.name)
+
+
+def _prefix_at_depth(name, depth):
+    """Returns the first depth "directories" of a blob name, e.g. 'logs/2024/'."""
+    cut = 0
+    for _ in range(depth):
+        slash = name.find('/', cut)
+        if slash == -1:
+            break
+        cut = slash + 1
+    return name[:cut]
+
+
+def usage_report(bucket_name, depth=1, prefix=None, output_format='json', workers=DEFAULT_WORKERS):
+    """
+    Reports where the space in a bucket goes: object count, total bytes and
+    size and age histograms per prefix (down to depth levels) and storage
+    class. The listing is streamed into one fixed-size counter array per
+    (prefix, storage class), so memory doesn't grow with the object count.
+    """
+    # bucket_name = "your-bucket-name"
+
+    size_limits = [limit for limit, label in USAGE_SIZE_BINS]
+    size_labels = [label for limit, label in USAGE_SIZE_BINS] + ['>=' + USAGE_SIZE_BINS[-1][1][1:]]
+    age_limits = [limit for limit, label in USAGE_AGE_BINS]
+    age_labels = [label for limit, label in USAGE_AGE_BINS] + ['>=' + USAGE_AGE_BINS[-1][1][1:]]
+
+    # Counter layout: objects, bytes, size histogram, age histogram.
+    size_base = 2
+    age_base = size_base + len(size_labels)
+    width = age_base + len(age_labels)
+
+    totals = {}
+    now = datetime.now(timezone.utc)
+    progress = Progress('Scanned', interval=10)
+    fields = ('name', 'size', 'storageClass', 'updated')
+
+    for blob in iter_blobs_sharded(bucket_name, prefix=prefix, workers=workers, fields=fields):
+        key = (_prefix_at_depth(blob.name, depth), blob.storage_class)
+        counters = totals.get(key)
+        if counters is None:
+            counters = totals[key] = array('q', [0] * width)
+
+        size = blob.size or 0
+        age_days = (now - blob.updated).days if blob.updated else 0
+        counters[0] += 1
+        counters[1] += size
+        counters[size_base + bisect.bisect_right(size_limits, size)] += 1
+        counters[age_base + bisect.bisect_right(age_limits, age_days)] += 1
+        progress.add(1)
+
+    progress.report()
+
+    rows = []
+    for (row_prefix, storage_class), counters in sorted(totals.items()):
+        row = {'prefix': row_prefix, 'storage_class': storage_class,
+               'objects': counters[0], 'bytes': counters[1]}
+        row.update(('size ' + label, counters[size_base + i]) for i, label in enumerate(size_labels))
+        row.update(('age ' + label, counters[age_base + i]) for i, label in enumerate(age_labels))
+        rows.append(row)
+
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]) if rows else ['prefix'])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        print(json.dumps(rows, indent=2))
+
+    return rows
+
+
+def index_bucket(bucket_name, prefixes=None, notifications=None, workers=DEFAULT_WORKERS):
+    """
+    Builds or refreshes the bucket's local metadata index. Notifications (a
+    file of object change messages) are replayed and the given prefixes are
+    re-listed; with neither, the whole bucket is listed again.
+    """
+    # bucket_name = "your-bucket-name"
+    # prefixes = ["logs/2024-06-01/"]
+    # notifications = "notifications.jsonl"
+
+    conn = gs_index.open_index(bucket_name, create=True)
+
+    if notifications:
+        with open(notifications) as notifications_file:
+            applied = gs_index.apply_notifications(conn, notifications_file)
+        print('Applied {} notifications from {}'.format(applied, notifications))
+
+    if not notifications and not prefixes:
+        prefixes = ['']
+
+    for prefix in prefixes or []:
+        blobs = iter_blobs_sharded(bucket_name, prefix=prefix or None, workers=workers,
+                                   fields=gs_index.INDEX_FIELDS)
+        written = gs_index.replace_prefix(conn, prefix, (gs_index.blob_record(blob) for blob in blobs))
+        print('Indexed {} blobs under {!r}'.format(written, prefix))
+
+    print('Index {} holds {} blobs'.format(gs_index.index_path(bucket_name), gs_index.count(conn)))
+    conn.close()
 
-    # Note: Client.list_blobs requires at least package version 1.17.0.
-    blobs = storage_client.list_blobs(bucket_name)
+
+def _blob_refs(storage_client, bucket_name, versions=False):
+    """
+    Streams (blob_name, generation) pairs for the bucket, fetching only the
+    fields needed to delete them. The generation is None unless versions is
+    set, in which case every noncurrent version is listed too.
+    """
+    fields = 'items(name,generation),nextPageToken'
+    blobs = storage_client.list_blobs(bucket_name, versions=versions, fields=fields)
 
     for blob in blobs:
-        print(blob.name)
+        yield blob.name, blob.generation if versions else None
+
+
+def _confirmed(action):
+    confirm = input('Are you SURE you want to {} (CANNOT BE UNDONE)? '.format(action))
+    if confirm.casefold() in ('y', 'yes'):
+        return True
+    print('Cancelled.')
+    return False
 
-def empty_bucket(bucket_name):
-    """Deletes all the blobs in the bucket."""
+
+def empty_bucket(bucket_name, workers=DEFAULT_WORKERS, ask=True):
+    """Deletes all the blobs in the bucket, after asking unless ask is False."""
     # bucket_name = "your-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     bucket_exists = storage_client.lookup_bucket(bucket_name)
 
-    if bucket_exists:
-        confirm = input('Are you SURE you want to delete {} (CANNOT BE UNDONE)? '.format(bucket_name))
-    else:
+    if not bucket_exists:
         print("Bucket {} doesn't exist.".format(bucket_name))
         exit()
+    if ask and not _confirmed('delete {}'.format(bucket_name)):
+        return
 
-    blobs = storage_client.list_blobs(bucket_name)
-
-    blob_list = [blob.name for blob in storage_client.list_blobs(bucket_name)]
-    blob_count = len(blob_list)
+    deleted = delete_blobs(bucket_name, _blob_refs(storage_client, bucket_name), workers=workers)
 
-    if blob_count > 0:
-        for blob in blobs:
-            print('Deleting:', blob.name)
-            blob.delete()
-    else:
+    if deleted == 0:
         print('Bucket {} is already empty.'.format(bucket_name))
 
 
-def delete_bucket(bucket_name):
-    """Deletes a bucket. The bucket must be empty."""
+def delete_bucket(bucket_name, from_index=False, ask=True):
+    """
+    Deletes a bucket, after asking unless ask is False. The bucket must be
+    empty. With from_index set, the emptiness check reads the local index
+    instead of listing the bucket.
+    """
     # bucket_name = "your-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     bucket_exists = storage_client.lookup_bucket(bucket_name)
 
-    if bucket_exists:
-        confirm = input('Are you SURE you want to delete {} (CANNOT BE UNDONE)? '.format(bucket_name))
-    else:
+    if not bucket_exists:
         print("Bucket {} doesn't exist.".format(bucket_name))
         exit()
+    if ask and not _confirmed('delete {}'.format(bucket_name)):
+        return
 
     bucket = storage_client.get_bucket(bucket_name)
 
-    blob_count = len([blob.name for blob in storage_client.list_blobs(bucket_name)])
-    #blob_count = len(blob_list)
+    if from_index:
+        conn = gs_index.open_index(bucket_name)
+        blob_count = gs_index.count(conn)
+        conn.close()
+    else:
+        blob_count = len([blob.name for blob in storage_client.list_blobs(bucket_name)])
 
     print('')
     print('\tblob_count:', blob_count)
@@ -132,36 +501,135 @@ def delete_bucket(bucket_name):
         print('Bucket is not empty. Please empty before deleting.')
 
 
-def foce_delete_bucket(bucket_name):
-    """Empties and then deletes a bucket."""
+def foce_delete_bucket(bucket_name, workers=DEFAULT_WORKERS, ask=True):
+    """Empties and then deletes a bucket, after asking unless ask is False."""
     # bucket_name = "your-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     bucket_exists = storage_client.lookup_bucket(bucket_name)
 
-    if bucket_exists:
-        confirm = input('Are you SURE you want to delete {} (CANNOT BE UNDONE)? '.format(bucket_name))
-    else:
+    if not bucket_exists:
         print("Bucket {} doesn't exist.".format(bucket_name))
         exit()
+    if ask and not _confirmed('delete {}'.format(bucket_name)):
+        return
 
     bucket = storage_client.get_bucket(bucket_name)
-    blobs = storage_client.list_blobs(bucket_name)
 
-    for blob in blobs:
-        print('Deleting:', blob.name)
-        blob.delete()
+    # Noncurrent versions also have to go before the bucket can be deleted.
+    delete_blobs(bucket_name, _blob_refs(storage_client, bucket_name, versions=True), workers=workers)
 
     bucket.delete()
 
     print("Bucket {} emptied and force deleted".format(bucket_name))
 
 
-def migrate_bucket(bucket_name, dest_bucket_name):
-    """Deletes all the blobs in the bucket."""
+class _Checkpoint:
+    """
+    Append-only manifest of a migration. Each line records either a finished
+    copy or the latest rewrite token of a copy still in flight.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.copied = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a killed run.
+                        continue
+                    if entry.get('token'):
+                        self.tokens[entry['name']] = (entry['generation'], entry['token'])
+                    else:
+                        self.copied[entry['name']] = entry['generation']
+                        self.tokens.pop(entry['name'], None)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self.file = open(path, 'a')
+
+    def is_copied(self, blob_name, generation):
+        return self.copied.get(blob_name) == generation
+
+    def token(self, blob_name, generation):
+        """Returns the saved rewrite token, if it belongs to this generation."""
+        saved_generation, token = self.tokens.get(blob_name, (None, None))
+        return token if saved_generation == generation else None
+
+    def record(self, blob_name, generation, token=None):
+        line = json.dumps({'name': blob_name, 'generation': generation, 'token': token})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _checkpoint_path(bucket_name, dest_bucket_name):
+    return os.path.join(CHECKPOINT_DIR, '{}--{}.jsonl'.format(bucket_name, dest_bucket_name))
+
+
+def _migrate_blobs(bucket_name, dest_bucket_name, blobs, workers, checkpoint):
+    """
+    Rewrites a stream of (blob_name, generation) pairs into the destination
+    bucket over a worker pool, skipping copies the checkpoint already holds.
+    Returns the names that failed.
+    """
+    def migrate_one(ref):
+        blob_name, generation = ref
+
+        def save_token(token, bytes_rewritten, total_bytes):
+            if token:
+                checkpoint.record(blob_name, generation, token)
+
+        token = checkpoint.token(blob_name, generation)
+        try:
+            rewrite_blob(bucket_name, blob_name, dest_bucket_name, blob_name,
+                         generation=generation, token=token, on_progress=save_token)
+        except exceptions.BadRequest:
+            if token is None:
+                raise
+            # Rewrite tokens expire; start this object over.
+            rewrite_blob(bucket_name, blob_name, dest_bucket_name, blob_name,
+                         generation=generation, on_progress=save_token)
+        checkpoint.record(blob_name, generation)
+
+    todo = (ref for ref in blobs if not checkpoint.is_copied(*ref))
+    progress = Progress('Copied')
+    failed = []
+
+    for (blob_name, generation), future in bounded_map(migrate_one, todo, workers):
+        try:
+            future.result()
+        except exceptions.GoogleAPICallError as error:
+            print('Failed to copy {}: {}'.format(blob_name, error))
+            failed.append(blob_name)
+        else:
+            progress.add(1)
+
+    progress.report()
+    return failed
+
+
+def migrate_bucket(bucket_name, dest_bucket_name, workers=DEFAULT_WORKERS, checkpoint_path=None,
+                   from_index=False):
+    """
+    Copies all the blobs in the bucket to another bucket. Progress is kept
+    in a checkpoint manifest, so running it again after an interruption
+    resumes where it stopped instead of copying everything again. With
+    from_index set, the blobs to copy come from the local index.
+    """
     # bucket_name = "your-bucket-name"
+    # dest_bucket_name = "your-destination-bucket-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     source_bucket = storage_client.get_bucket(bucket_name)
 
     dest_exists = storage_client.lookup_bucket(dest_bucket_name)
@@ -171,13 +639,144 @@ def migrate_bucket(bucket_name, dest_bucket_name):
     else:
         print("Destination bucket doesn't exist, creating.")
         create_bucket_class_location(dest_bucket_name)
-    dest_bucket = storage_client.get_bucket(dest_bucket_name)
 
-    blobs = storage_client.list_blobs(bucket_name)
+    if checkpoint_path is None:
+        checkpoint_path = _checkpoint_path(bucket_name, dest_bucket_name)
+    checkpoint = _Checkpoint(checkpoint_path)
+    print('Checkpoint manifest:', checkpoint_path)
 
-    for blob in blobs:
-        print('Copying:', blob.name)
-        source_bucket.copy_blob(blob, dest_bucket, blob.name)
+    if from_index:
+        conn = gs_index.open_index(bucket_name)
+        blobs = ((row['name'], row['generation']) for row in gs_index.query(conn))
+    else:
+        conn = None
+        fields = 'items(name,generation),nextPageToken'
+        blobs = ((blob.name, blob.generation)
+                 for blob in storage_client.list_blobs(bucket_name, fields=fields))
+
+    try:
+        failed = _migrate_blobs(bucket_name, dest_bucket_name, blobs, workers, checkpoint)
+    finally:
+        checkpoint.close()
+        if conn is not None:
+            conn.close()
+
+    if failed:
+        print('{} blobs failed to copy. Run the migration again to retry them.'.format(len(failed)))
+    return failed
+
+
+def _diff_listings(source_blobs, dest_blobs):
+    """
+    Merge-joins two listings, both in lexicographic name order as GCS
+    returns them. Yields ('copy', blob) for source blobs missing from or
+    different at the destination, and ('delete', blob) for destination
+    blobs with no source.
+    """
+    source_blobs = iter(source_blobs)
+    dest_blobs = iter(dest_blobs)
+    source = next(source_blobs, None)
+    dest = next(dest_blobs, None)
+
+    while source is not None or dest is not None:
+        if dest is None or (source is not None and source.name < dest.name):
+            yield 'copy', source
+            source = next(source_blobs, None)
+        elif source is None or dest.name < source.name:
+            yield 'delete', dest
+            dest = next(dest_blobs, None)
+        else:
+            if source.size != dest.size or source.crc32c != dest.crc32c:
+                yield 'copy', source
+            source = next(source_blobs, None)
+            dest = next(dest_blobs, None)
+
+
+def sync_bucket(bucket_name, dest_bucket_name, delete=False, dry_run=False, workers=DEFAULT_WORKERS):
+    """
+    Makes the destination bucket match the source, rsync style. Only blobs
+    that are missing or differ in size or crc32c are copied, so re-syncing
+    a mostly unchanged bucket costs little more than the two listings. With
+    delete set, destination blobs that no longer exist at the source are
+    removed as well.
+    """
+    # bucket_name = "your-bucket-name"
+    # dest_bucket_name = "your-destination-bucket-name"
+
+    storage_client = get_client()
+    fields = 'items(name,size,crc32c,generation),nextPageToken'
+
+    if dry_run:
+        # A missing destination just means everything would be copied.
+        dest_blobs = ()
+        if storage_client.lookup_bucket(dest_bucket_name):
+            dest_blobs = storage_client.list_blobs(dest_bucket_name, fields=fields)
+        source_blobs = storage_client.list_blobs(bucket_name, fields=fields)
+        for action, blob in _diff_listings(source_blobs, dest_blobs):
+            if action == 'copy' or delete:
+                print('Would {}: {}'.format(action, blob.name))
+        return []
+
+    if not storage_client.lookup_bucket(dest_bucket_name):
+        print("Destination bucket doesn't exist, creating.")
+        create_bucket_class_location(dest_bucket_name)
+
+    source_blobs = storage_client.list_blobs(bucket_name, fields=fields)
+    dest_blobs = storage_client.list_blobs(dest_bucket_name, fields=fields)
+    changes = _diff_listings(source_blobs, dest_blobs)
+
+    # Deletes run alongside the copies on their own thread, fed through a
+    # bounded queue so neither side has to hold the whole difference.
+    doomed = queue.Queue(maxsize=DELETE_BATCH_SIZE * workers)
+    executor = ThreadPoolExecutor(max_workers=1)
+    deleter = None
+    if delete:
+        deleter = executor.submit(delete_blobs, dest_bucket_name, iter(doomed.get, None), workers=workers)
+
+    def put_doomed(item):
+        # A deleter that died would never drain the queue, so wait on it in
+        # short steps and raise its error instead of blocking for ever.
+        while True:
+            if deleter.done():
+                deleter.result()
+                raise RuntimeError('Deleter stopped before the sync finished')
+            try:
+                doomed.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def copies():
+        for action, blob in changes:
+            if action == 'copy':
+                yield blob.name, blob.generation
+            elif delete:
+                put_doomed((blob.name, None))
+
+    # The checkpoint only carries rewrite tokens across an interrupted sync;
+    # the next listing decides what still needs copying.
+    checkpoint_path = _checkpoint_path(bucket_name, dest_bucket_name) + '.sync'
+    checkpoint = _Checkpoint(checkpoint_path)
+    try:
+        failed = _migrate_blobs(bucket_name, dest_bucket_name, copies(), workers, checkpoint)
+    finally:
+        checkpoint.close()
+        # Let the deleter finish what's queued, even if copying failed.
+        while delete and not deleter.done():
+            try:
+                doomed.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        executor.shutdown()
+    if delete:
+        deleter.result()
+
+    if failed:
+        print('{} blobs failed to copy. Run the sync again to retry them.'.format(len(failed)))
+    else:
+        os.remove(checkpoint_path)
+    return failed
 
 
 if __name__ == '__main__':
@@ -185,15 +784,36 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--create", metavar="bucket_name", help="Create bucket")
     parser.add_argument("-d", "--delete", metavar="bucket_name", help="Delete bucket")
-    parser.add_argument("-i", "--info", metavar="bucket_name", help="Delete bucket")
+    parser.add_argument("-i", "--info", metavar="bucket_name", help="Show bucket metadata")
+    parser.add_argument("--info-many", nargs="*", metavar="bucket_name", help="Metadata of several buckets (all buckets if none given)")
+    parser.add_argument("--format", choices=("json", "csv"), default="json", help="Output format for --info-many and --usage")
+    parser.add_argument("--ttl", type=int, default=METADATA_TTL, help="Seconds --info-many trusts cached metadata without revalidating")
     parser.add_argument("-l", "--list", metavar="bucket_name", help="List bucket contents")
+    parser.add_argument("--prefix", help="Only list blobs whose names start with this prefix")
+    parser.add_argument("--jsonl", action="store_true", help="List blobs as JSON lines")
+    parser.add_argument("--fields", default=','.join(DEFAULT_LIST_FIELDS), help="Comma separated blob fields for --jsonl, from: " + ', '.join(LIST_FIELDS))
+    parser.add_argument("-u", "--usage", metavar="bucket_name", help="Report object counts and bytes by prefix and storage class")
+    parser.add_argument("--depth", type=int, default=1, help="Prefix levels to break --usage down by")
+    parser.add_argument("--min-size", type=parse_size, help="Only list blobs of at least this size, e.g. 1G")
+    parser.add_argument("--index", metavar="bucket_name", help="Build or refresh the local metadata index of a bucket")
+    parser.add_argument("--refresh-prefix", action="append", metavar="prefix", help="With --index, re-list only this prefix (repeatable)")
+    parser.add_argument("--notifications", metavar="path", help="With --index, replay object change notifications from a file")
+    parser.add_argument("--from-index", action="store_true", help="Answer --list, --delete and --migrate from the local index")
     parser.add_argument("-m", "--migrate", metavar="bucket_name", help="Migrate bucket contents to another bucket")
+    parser.add_argument("-s", "--sync", metavar="bucket_name", help="Copy only new and changed blobs to another bucket")
     parser.add_argument("--dest", metavar="bucket_name", help="Destination bucket name")
+    parser.add_argument("--delete-extra", action="store_true", help="With --sync, delete destination blobs missing from the source")
+    parser.add_argument("--dry-run", action="store_true", help="With --sync, only print what would change")
+    parser.add_argument("--checkpoint", metavar="path", help="Checkpoint manifest used to resume a migration")
     parser.add_argument("--empty", metavar="bucket_name", help="Empties bucket contents")
     parser.add_argument("--force-delete", metavar="bucket_name", help="Empties and permanently deletes bucket")
     parser.add_argument("-lb", "--list-buckets", action="store_true", help="List all buckets")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent requests for bulk operations")
+    parser.add_argument("--pool-size", type=int, help="HTTP connections to keep open to Cloud Storage (default: enough for --workers)")
     args = parser.parse_args()
 
+    configure(pool_size=args.pool_size or max(DEFAULT_POOL_SIZE, args.workers))
+
     if args.create:
         bucket_name = args.create
         print('Creating bucket:', bucket_name)
@@ -203,7 +823,7 @@ if __name__ == '__main__':
     if args.delete:
         bucket_name = args.delete
         print('Deleting bucket:', bucket_name)
-        delete_bucket(bucket_name)
+        delete_bucket(bucket_name, from_index=args.from_index)
         list_buckets()
 
     if args.info:
@@ -211,10 +831,28 @@ if __name__ == '__main__':
         print('Getting info for bucket:', bucket_name)
         bucket_metadata(bucket_name)
 
+    if args.info_many is not None:
+        buckets_metadata(args.info_many, output_format=args.format, ttl=args.ttl, workers=args.workers)
+
     if args.list:
         bucket_name = args.list
-        print('Listing bucket contents:')
-        list_blobs(bucket_name)
+        fields = tuple(args.fields.split(','))
+        unknown = set(fields) - set(LIST_FIELDS)
+        if unknown:
+            print('Unknown fields:', ', '.join(sorted(unknown)))
+            exit()
+        if not args.jsonl:
+            print('Listing bucket contents:')
+        list_blobs(bucket_name, prefix=args.prefix, workers=args.workers, json_lines=args.jsonl,
+                   fields=fields, from_index=args.from_index, min_size=args.min_size)
+
+    if args.usage:
+        usage_report(args.usage, depth=args.depth, prefix=args.prefix, output_format=args.format,
+                     workers=args.workers)
+
+    if args.index:
+        index_bucket(args.index, prefixes=args.refresh_prefix, notifications=args.notifications,
+                     workers=args.workers)
 
     if args.list_buckets:
         print('Listing buckets:')
@@ -222,20 +860,22 @@ if __name__ == '__main__':
 
     if args.empty:
         bucket_name = args.empty
-        empty_bucket(bucket_name)
+        empty_bucket(bucket_name, workers=args.workers)
 
     if args.force_delete:
         bucket_name = args.force_delete
-        confirm = input('Are you SURE you want to empty ' + bucket_name + ' (CANNOT BE UNDONE)? ')
-        if confirm.casefold() == 'y':
+        if _confirmed('empty and delete ' + bucket_name):
             print('Emptying bucket contents:')
-            empty_bucket(bucket_name)
+            empty_bucket(bucket_name, workers=args.workers, ask=False)
             print('Deleting bucket:', bucket_name)
-            delete_bucket(bucket_name)
+            delete_bucket(bucket_name, ask=False)
             list_buckets()
 
     if args.migrate and args.dest:
         bucket_name = args.migrate
         dest_bucket_name = args.dest
-        migrate_bucket(bucket_name, dest_bucket_name) 
+        migrate_bucket(bucket_name, dest_bucket_name, workers=args.workers, checkpoint_path=args.checkpoint,
+                       from_index=args.from_index)
 
+    if args.sync and args.dest:
+        sync_bucket(args.sync, args.dest, delete=args.delete_extra, dry_run=args.dry_run, workers=args.workers)
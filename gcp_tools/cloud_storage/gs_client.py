@@ -0,0 +1,84 @@
+#!/usr/local/bin/python3
+
+import os
+import threading
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# Process-wide storage client layer for the gs_* tools. Credentials are
+# discovered once, on first use, and every client shares one authorized
+# HTTP session, so bulk operations reuse warm connections instead of
+# redoing TLS handshakes and auth for each call.
+
+DEFAULT_POOL_SIZE = int(os.environ.get('GCS_POOL_SIZE', 32))
+
+_lock = threading.Lock()
+_thread_state = threading.local()
+_pool_size = DEFAULT_POOL_SIZE
+_credentials = None
+_project = None
+_session = None
+
+
+def _mount_adapters(session, pool_size):
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    # Local fake GCS servers are usually plain HTTP.
+    session.mount('http://', adapter)
+
+
+def configure(pool_size=None):
+    """
+    Sets the number of HTTP connections kept open to Cloud Storage. Size it
+    to at least the number of worker threads sharing the clients.
+    """
+    global _pool_size
+
+    with _lock:
+        if pool_size:
+            _pool_size = pool_size
+            if _session is not None:
+                _mount_adapters(_session, _pool_size)
+
+
+def _shared_session():
+    """Loads credentials and builds the pooled session the first time it's needed."""
+    global _credentials, _project, _session
+
+    with _lock:
+        if _session is None:
+            if os.environ.get('STORAGE_EMULATOR_HOST'):
+                _credentials = AnonymousCredentials()
+                _project = os.environ.get('GOOGLE_CLOUD_PROJECT', 'test-project')
+            else:
+                _credentials, _project = google.auth.default(scopes=storage.Client.SCOPE)
+            session = AuthorizedSession(_credentials)
+            _mount_adapters(session, _pool_size)
+            _session = session
+
+    return _credentials, _project, _session
+
+
+def get_client():
+    """
+    Returns the calling thread's storage client. Clients aren't shared
+    between threads (batches are tracked per client), but they are cheap
+    to build because they all wrap the same credentials and session.
+    """
+    storage_client = getattr(_thread_state, 'storage_client', None)
+
+    if storage_client is None:
+        credentials, project, session = _shared_session()
+        storage_client = storage.Client(project=project, credentials=credentials, _http=session)
+        _thread_state.storage_client = storage_client
+
+    return storage_client
+
+
+def get_session():
+    """Returns the shared authorized session for calls the client library doesn't cover."""
+    return _shared_session()[2]
@@ -1,12 +1,547 @@
 #!/usr/local/bin/python3
 
+import base64
+import fnmatch
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import mimetypes
 import os
-import google.cloud
-from google.oauth2 import service_account
-from google.cloud import storage
+import queue
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to the bucket."""
+import google_crc32c
+from google.api_core import exceptions
+
+from gs_client import DEFAULT_POOL_SIZE, configure, get_client, get_session
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed for zstd compressed uploads and downloads.
+    zstandard = None
+
+# The JSON API accepts at most 100 calls in a single batch request.
+DELETE_BATCH_SIZE = 100
+DEFAULT_WORKERS = 8
+
+# Files at least this big are uploaded as parallel composite uploads.
+COMPOSITE_UPLOAD_THRESHOLD = 150 << 20
+COMPOSITE_PARTS = 32
+# Parts are never bigger than this, however big the file. An interrupted
+# part is uploaded again from its start, so this caps the work a failure
+# throws away (a 200 GB file goes up as 400 parts rather than 32 of 6 GB).
+COMPOSITE_PART_MAX = 512 << 20
+# A single compose request takes at most 32 source objects.
+MAX_COMPOSE_SOURCES = 32
+# Temporary composite components live under this prefix until composed.
+COMPONENT_PREFIX = '.composite-parts/'
+
+# Objects at least this big are downloaded as concurrent byte-range slices.
+SLICED_DOWNLOAD_THRESHOLD = 150 << 20
+DOWNLOAD_SLICES = 8
+# Sliced downloads record their progress in this file next to the
+# destination, at most every STATE_SAVE_INTERVAL bytes per slice.
+SLICE_STATE_SUFFIX = '.slices'
+STATE_SAVE_INTERVAL = 64 << 20
+
+# Streaming transfers move data in chunks of this size (a multiple of the
+# 256 KiB resumable upload granularity), holding at most STREAM_BUFFERS
+# chunks in memory.
+STREAM_CHUNK_SIZE = 16 << 20
+STREAM_BUFFERS = 4
+
+# Files at least this big that aren't sent as composite uploads use
+# resumable sessions saved under RESUMABLE_STATE_DIR, so an interrupted
+# upload continues from the last committed byte on the next run. Chunk
+# sizes adapt between the limits to keep each request near the target time.
+RESUMABLE_THRESHOLD = 64 << 20
+RESUMABLE_STATE_DIR = os.path.expanduser('~/.cache/gcp_tools/uploads')
+RESUMABLE_CHUNK_SIZE = 8 << 20
+RESUMABLE_CHUNK_MIN = 256 << 10
+RESUMABLE_CHUNK_MAX = 256 << 20
+RESUMABLE_CHUNK_SECONDS = (2, 20)
+RESUMABLE_RETRIES = 8
+
+# Compressed uploads. gzip objects carry Content-Encoding, so Cloud Storage
+# and browsers decompress them; zstd objects are marked with a custom
+# metadata key and decompressed by download_blob. Files are compressed in
+# COMPRESS_BLOCK_SIZE blocks spread over the workers.
+COMPRESSIONS = ('gzip', 'zstd')
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+COMPRESSION_METADATA_KEY = 'compression'
+COMPRESS_BLOCK_SIZE = 16 << 20
+# Content that's already compressed is uploaded as is. Anything else is
+# sampled, and skipped unless the sample shrinks below COMPRESSION_MIN_RATIO.
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip',
+                        'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+                        'application/x-7z-compressed', 'application/x-rar-compressed',
+                        'application/zstd', 'application/pdf')
+INCOMPRESSIBLE_EXTENSIONS = ('.zst', '.lz4', '.snappy', '.parquet', '.orc', '.avro', '.jar', '.whl')
+COMPRESSION_SAMPLE_SIZE = 1 << 20
+COMPRESSION_MIN_RATIO = 0.9
+
+# Journals of prefix moves, recording which objects have been copied and
+# which deleted.
+MOVE_JOURNAL_DIR = os.path.expanduser('~/.cache/gcp_tools/moves')
+
+# Local (path, size, mtime) -> crc32c cache, so unchanged files are never
+# hashed twice.
+CHECKSUM_CACHE = os.path.expanduser('~/.cache/gcp_tools/crc32c_cache.db')
+
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+
+def _chunked(iterable, size):
+    """Groups an iterable into lists of at most size items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bounded_map(fn, items, workers=DEFAULT_WORKERS):
+    """
+    Runs fn over items on a thread pool and yields (item, future) pairs as
+    they finish. Only a couple of items per worker are queued at a time, so
+    items can be a lazy stream of any length.
+    """
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future
+            pending[executor.submit(fn, item)] = item
+
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future
+
+
+def parse_size(size):
+    """Parses a byte count such as 1048576, 512K, 100M or 1G."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class Progress:
+    """Prints a running total and throughput at most every few seconds."""
+
+    def __init__(self, verb, interval=5):
+        self.verb = verb
+        self.interval = interval
+        self.count = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def add(self, count):
+        self.count += count
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.count / elapsed if elapsed else 0.0
+        # Progress goes to stderr so it never mixes with listing output.
+        print("{} {} objects in {:.1f}s ({:.1f} objects/s)".format(
+            self.verb, self.count, elapsed, rate), file=sys.stderr)
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def _crc32c_combine(crc1, crc2, length2):
+    """
+    Returns the crc32c of two byte strings joined together, given the crc32c
+    of each and the length of the second (zlib's crc32_combine, CRC-32C
+    polynomial). This checks a composite or sliced object against its parts
+    without reading the data again.
+    """
+    if length2 == 0:
+        return crc1
+
+    odd = [CRC32C_POLYNOMIAL] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+
+    while True:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+    return crc1 ^ crc2
+
+
+def _decode_crc32c(value):
+    """Decodes the base64 big-endian crc32c GCS reports for an object."""
+    return struct.unpack('>I', base64.b64decode(value))[0]
+
+
+def _encode_crc32c(crc):
+    return base64.b64encode(struct.pack('>I', crc)).decode('ascii')
+
+
+class _FileSlice:
+    """
+    Read-only file object over one byte range of an open file descriptor.
+    Reads go through os.pread, so several slices of the same file can be
+    uploaded at once without sharing a file position or copying the file.
+    """
+
+    def __init__(self, fd, offset, length):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = os.pread(self.fd, size, self.offset + self.position)
+        self.position += len(data)
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self.position = max(0, min(position, self.length))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def _compose(bucket, destination_blob, sources, temp_prefix, workers):
+    """
+    Composes sources into destination_blob. More than 32 sources are first
+    composed in groups of 32 into intermediate objects under temp_prefix,
+    as many levels deep as needed.
+    """
+    level = 0
+
+    while len(sources) > MAX_COMPOSE_SOURCES:
+        groups = list(enumerate(_chunked(sources, MAX_COMPOSE_SOURCES)))
+
+        def compose_group(numbered_group):
+            index, group = numbered_group
+            intermediate = bucket.blob('{}compose-{}-{:05d}'.format(temp_prefix, level, index))
+            intermediate.compose(group)
+            return intermediate
+
+        composed = {}
+        for (index, group), future in bounded_map(compose_group, groups, workers):
+            composed[index] = future.result()
+        sources = [composed[index] for index in range(len(groups))]
+        level += 1
+
+    destination_blob.compose(sources)
+
+
+def upload_blob_composite(bucket_name, source_file_name, destination_blob_name,
+                          parts=COMPOSITE_PARTS, workers=DEFAULT_WORKERS):
+    """
+    Uploads a large file as a parallel composite upload. The file is split
+    into parts slices, or more if they would exceed COMPOSITE_PART_MAX,
+    that are uploaded concurrently as temporary objects, composed into the
+    destination, checked against the crc32c of the parts and then deleted.
+    If the upload is interrupted the parts are kept, and running it again
+    only uploads the ones that are missing.
+    """
+    # bucket_name = "your-bucket-name"
+    # source_file_name = "local/path/to/file"
+    # destination_blob_name = "storage-object-name"
+
+    storage_client = get_client()
+    bucket = storage_client.bucket(bucket_name)
+
+    stat = os.stat(source_file_name)
+    size = stat.st_size
+    parts = max(parts, -(-size // COMPOSITE_PART_MAX))
+    part_size = max(1, -(-size // parts))
+    offsets = list(range(0, size, part_size)) or [0]
+
+    # Parts are named after the file and its version, so a rerun finds
+    # the ones an interrupted attempt already uploaded.
+    upload = '\n'.join((bucket_name, os.path.abspath(source_file_name), destination_blob_name,
+                        str(size), str(stat.st_mtime_ns), str(parts)))
+    temp_prefix = '{}{}/'.format(COMPONENT_PREFIX, hashlib.sha1(upload.encode('utf-8')).hexdigest()[:16])
+    fields = 'items(name,size,crc32c),nextPageToken'
+    uploaded = {blob.name: blob
+                for blob in storage_client.list_blobs(bucket_name, prefix=temp_prefix, fields=fields)}
+
+    fd = os.open(source_file_name, os.O_RDONLY)
+    try:
+        def upload_part(index):
+            offset = offsets[index]
+            length = min(part_size, size - offset)
+            component_name = '{}part-{:05d}'.format(temp_prefix, index)
+
+            existing = uploaded.get(component_name)
+            if existing is not None and existing.size == length and \
+                    existing.crc32c == _encode_crc32c(_file_range_crc32c(fd, offset, offset + length)):
+                return existing
+
+            component = get_client().bucket(bucket_name).blob(component_name)
+            component.upload_from_file(_FileSlice(fd, offset, length), size=length, checksum='crc32c')
+            return component
+
+        components = [None] * len(offsets)
+        for index, future in bounded_map(upload_part, range(len(offsets)), min(workers, len(offsets))):
+            components[index] = future.result()
+
+        destination_blob = bucket.blob(destination_blob_name)
+        destination_blob.content_type = mimetypes.guess_type(source_file_name)[0]
+        _compose(bucket, destination_blob, components, temp_prefix, workers)
+    except Exception:
+        print('Parts uploaded so far are kept under {} for the next attempt.'.format(temp_prefix))
+        raise
+    finally:
+        os.close(fd)
+
+    fields = 'items(name),nextPageToken'
+    temporaries = storage_client.list_blobs(bucket_name, prefix=temp_prefix, fields=fields)
+    delete_blobs(bucket_name, ((temporary.name, None) for temporary in temporaries), workers=workers)
+
+    expected = _decode_crc32c(components[0].crc32c)
+    for component in components[1:]:
+        expected = _crc32c_combine(expected, _decode_crc32c(component.crc32c), component.size)
+    if _decode_crc32c(destination_blob.crc32c) != expected:
+        raise ValueError('crc32c of composite {} is {}, expected {}'.format(
+            destination_blob_name, destination_blob.crc32c, _encode_crc32c(expected)))
+
+    return destination_blob
+
+
+def _file_range_crc32c(fd, start, end, crc=0):
+    """Extends crc over bytes [start, end) of an open file."""
+    while start < end:
+        data = os.pread(fd, min(1 << 20, end - start), start)
+        if not data:
+            break
+        crc = google_crc32c.extend(crc, data)
+        start += len(data)
+    return crc
+
+
+def _resumable_state_path(bucket_name, source_file_name, destination_blob_name):
+    upload = '\n'.join((bucket_name, os.path.abspath(source_file_name), destination_blob_name))
+    return os.path.join(RESUMABLE_STATE_DIR, hashlib.sha1(upload.encode('utf-8')).hexdigest() + '.json')
+
+
+def _save_resumable_state(state_path, state):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def _committed_bytes(session, upload_url, size):
+    """
+    Asks a resumable session how much it has stored. Returns the byte count,
+    size once the upload is complete, or None when the session is gone.
+    """
+    response = session.put(upload_url, headers={'Content-Range': 'bytes */{}'.format(size)})
+    if response.status_code in (200, 201):
+        return size
+    if response.status_code == 308:
+        committed = response.headers.get('Range')
+        return int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+    if response.status_code in (404, 410):
+        return None
+    raise exceptions.from_http_response(response)
+
+
+def upload_blob_resumable(bucket_name, source_file_name, destination_blob_name,
+                          chunk_size=RESUMABLE_CHUNK_SIZE):
+    """
+    Uploads a file through a resumable session whose URI, committed offset
+    and running crc32c are saved locally after every chunk. If the upload
+    is interrupted, running it again asks the session how much it already
+    holds and continues from there. The crc32c of each chunk is folded into
+    a whole-file checksum that the server checks on the final chunk.
+    """
+    # bucket_name = "your-bucket-name"
+    # source_file_name = "local/path/to/file"
+    # destination_blob_name = "storage-object-name"
+
+    session = get_session()
+    stat = os.stat(source_file_name)
+    size = stat.st_size
+    state_path = _resumable_state_path(bucket_name, source_file_name, destination_blob_name)
+
+    state = None
+    if os.path.exists(state_path):
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            unchanged = (state['size'], state['mtime_ns']) == (size, stat.st_mtime_ns)
+        except (OSError, ValueError, KeyError, TypeError):
+            print('Saved state of {} is unreadable, starting over.'.format(source_file_name))
+            state = None
+        else:
+            if not unchanged:
+                print('{} changed since the last attempt, starting over.'.format(source_file_name))
+                state = None
+
+    fd = os.open(source_file_name, os.O_RDONLY)
+    try:
+        offset = None
+        if state is not None:
+            offset = _committed_bytes(session, state['url'], size)
+            if offset is None:
+                print('Upload session expired, starting over.')
+        if offset is None:
+            blob = get_client().bucket(bucket_name).blob(destination_blob_name)
+            upload_url = blob.create_resumable_upload_session(
+                content_type=mimetypes.guess_type(source_file_name)[0], size=size)
+            state = {'url': upload_url, 'size': size, 'mtime_ns': stat.st_mtime_ns, 'offset': 0, 'crc32c': 0}
+            offset = 0
+        elif offset > state['offset']:
+            # The session kept bytes we never got to record.
+            state['crc32c'] = _file_range_crc32c(fd, state['offset'], offset, state['crc32c'])
+            state['offset'] = offset
+        if offset:
+            print('Resuming upload of {} at byte {} of {}.'.format(source_file_name, offset, size))
+        _save_resumable_state(state_path, state)
+
+        failures = 0
+        resync = False
+        while True:
+            try:
+                if resync:
+                    # Find out what the failed request left behind before
+                    # sending more.
+                    committed = _committed_bytes(session, state['url'], size)
+                    if committed is None:
+                        raise ValueError('Upload session of {} expired, run the upload again.'.format(
+                            source_file_name))
+                    if committed > state['offset']:
+                        state['crc32c'] = _file_range_crc32c(fd, state['offset'], committed, state['crc32c'])
+                        state['offset'] = offset = committed
+                    resync = False
+            except (OSError, exceptions.ServerError, exceptions.TooManyRequests) as error:
+                failures += 1
+                if failures > RESUMABLE_RETRIES:
+                    raise
+                print('Checking upload progress failed ({}), retrying.'.format(error))
+                time.sleep(min(2 ** failures, 60))
+                continue
+
+            length = min(chunk_size, size - offset)
+            data = os.pread(fd, length, offset)
+            chunk_crc = google_crc32c.value(data)
+            headers = {'Content-Range': 'bytes {}-{}/{}'.format(offset, offset + length - 1, size)
+                       if length else 'bytes */{}'.format(size)}
+            if offset + length == size:
+                whole = _crc32c_combine(state['crc32c'], chunk_crc, length)
+                headers['X-Goog-Hash'] = 'crc32c=' + _encode_crc32c(whole)
+
+            started = time.monotonic()
+            try:
+                response = session.put(state['url'], data=data, headers=headers)
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise exceptions.from_http_response(response)
+            except (OSError, exceptions.ServerError, exceptions.TooManyRequests) as error:
+                failures += 1
+                if failures > RESUMABLE_RETRIES:
+                    raise
+                print('Chunk at byte {} failed ({}), retrying.'.format(offset, error))
+                time.sleep(min(2 ** failures, 60))
+                chunk_size = max(RESUMABLE_CHUNK_MIN, chunk_size // 2)
+                resync = True
+                continue
+            elapsed = time.monotonic() - started
+            failures = 0
+
+            if response.status_code in (200, 201):
+                uploaded = response.json()
+                if uploaded.get('crc32c') and uploaded['crc32c'] != headers['X-Goog-Hash'][len('crc32c='):]:
+                    # Resuming this session could only end the same way.
+                    os.remove(state_path)
+                    raise ValueError('crc32c of uploaded {} is {}, expected {}'.format(
+                        destination_blob_name, uploaded['crc32c'], headers['X-Goog-Hash']))
+                break
+            if response.status_code != 308:
+                if 'X-Goog-Hash' in headers:
+                    # The final chunk was refused, most likely on its checksum,
+                    # so the next run starts a fresh session.
+                    os.remove(state_path)
+                raise exceptions.from_http_response(response)
+
+            committed = response.headers.get('Range')
+            committed = int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+            # The server may keep only part of a chunk.
+            state['crc32c'] = _crc32c_combine(
+                state['crc32c'], google_crc32c.value(data[:committed - offset]), committed - offset)
+            state['offset'] = offset = committed
+            _save_resumable_state(state_path, state)
+
+            # Aim each request at a few seconds: long enough to amortise the
+            # round trip, short enough that a failure costs little.
+            if elapsed < RESUMABLE_CHUNK_SECONDS[0]:
+                chunk_size = min(RESUMABLE_CHUNK_MAX, chunk_size * 2)
+            elif elapsed > RESUMABLE_CHUNK_SECONDS[1]:
+                chunk_size = max(RESUMABLE_CHUNK_MIN, chunk_size // 2)
+    finally:
+        os.close(fd)
+
+    os.remove(state_path)
+
+
+def upload_blob(bucket_name, source_file_name, destination_blob_name,
+                parts=COMPOSITE_PARTS, threshold=COMPOSITE_UPLOAD_THRESHOLD, workers=DEFAULT_WORKERS,
+                resumable_threshold=RESUMABLE_THRESHOLD, compression=None):
+    """
+    Uploads a file to the bucket. Files of threshold bytes or more go up as
+    a parallel composite upload of parts slices. Otherwise files of
+    resumable_threshold bytes or more use a saved resumable session that
+    survives interruptions. With compression ('gzip' or 'zstd') the file is
+    compressed on the way up, unless it looks already compressed.
+    """
     # The ID of your GCS bucket
     # bucket_name = "your-bucket-name"
     # The path to your file to upload
@@ -14,11 +549,26 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
     # The ID of your GCS object
     # destination_blob_name = "storage-object-name"
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+    size = os.path.getsize(source_file_name)
+
+    if compression and not is_compressible(source_file_name):
+        print("{} looks already compressed, uploading it as is.".format(source_file_name))
+        compression = None
 
-    blob.upload_from_filename(source_file_name)
+    if compression:
+        upload_blob_compressed(bucket_name, source_file_name, destination_blob_name,
+                               compression=compression, workers=workers)
+    elif parts > 1 and size >= threshold:
+        upload_blob_composite(bucket_name, source_file_name, destination_blob_name,
+                              parts=parts, workers=workers)
+    elif size >= resumable_threshold:
+        upload_blob_resumable(bucket_name, source_file_name, destination_blob_name)
+    else:
+        storage_client = get_client()
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(destination_blob_name)
+
+        blob.upload_from_filename(source_file_name)
 
     print(
         "File {} uploaded to {}.".format(
@@ -26,8 +576,427 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
         )
     )
 
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    """Downloads a blob from the bucket."""
+
+def is_compressible(file_name, content_type=None):
+    """
+    Guesses whether compressing a file is worth it: known compressed types
+    and extensions are not, and anything else must shrink when a sample of
+    it is compressed quickly.
+    """
+    guessed_type, encoding = mimetypes.guess_type(file_name)
+    content_type = content_type or guessed_type or ''
+    if encoding or content_type.startswith(INCOMPRESSIBLE_TYPES) \
+            or file_name.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+        return False
+
+    with open(file_name, 'rb') as source_file:
+        sample = source_file.read(COMPRESSION_SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_MIN_RATIO
+
+
+class _ChunkReader:
+    """File object over an iterator of bytes, for uploading data produced on the fly."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.current = memoryview(b'')
+        self.position = 0
+        self.done = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        parts = []
+        while size > 0 and not self.done:
+            if not self.current:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    self.done = True
+                self.current = memoryview(chunk or b'')
+                continue
+            take = min(size, len(self.current))
+            parts.append(bytes(self.current[:take]))
+            self.current = self.current[take:]
+            self.position += take
+            size -= take
+        return b''.join(parts)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        # Like _RingReader, only "seeking" to the current position works.
+        if whence == io.SEEK_CUR:
+            position += self.position
+        if whence == io.SEEK_END or position != self.position:
+            raise io.UnsupportedOperation('stream is not seekable')
+        return self.position
+
+
+def _gzip_blocks(source_file, level, workers):
+    """
+    Yields the file as a multi-member gzip stream. Blocks are compressed as
+    independent members on a thread pool (zlib releases the GIL), read
+    ahead at most workers * 2 blocks, and yielded in order.
+    """
+    blocks = iter(lambda: source_file.read(COMPRESS_BLOCK_SIZE), b'')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        ahead = deque(executor.submit(gzip.compress, block, level, mtime=0)
+                      for block in itertools.islice(blocks, workers * 2))
+        while ahead:
+            data = ahead.popleft().result()
+            block = next(blocks, None)
+            if block is not None:
+                ahead.append(executor.submit(gzip.compress, block, level, mtime=0))
+            yield data
+
+
+def _zstd_chunks(source_file, level, workers):
+    """Yields the file as a zstd frame, compressed by zstandard's own worker threads."""
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+    return compressor.read_to_iter(source_file, read_size=COMPRESS_BLOCK_SIZE,
+                                   write_size=COMPRESS_BLOCK_SIZE)
+
+
+def _compression(blob):
+    """Returns how a blob's stored data is compressed: 'gzip', 'zstd' or None."""
+    if blob.content_encoding == 'gzip':
+        return 'gzip'
+    return (blob.metadata or {}).get(COMPRESSION_METADATA_KEY)
+
+
+def upload_blob_compressed(bucket_name, source_file_name, destination_blob_name, compression='gzip',
+                           level=None, workers=DEFAULT_WORKERS):
+    """
+    Uploads a file compressed on the fly as a chunked resumable upload, so
+    nothing is staged on disk. gzip objects are stored with Content-Encoding
+    gzip and the file's own content type; zstd objects are tagged in their
+    metadata. Returns the uploaded blob.
+    """
+    # bucket_name = "your-bucket-name"
+    # source_file_name = "local/path/to/file"
+    # destination_blob_name = "storage-object-name"
+    # compression = "gzip"
+
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {}, expected one of {}'.format(compression, COMPRESSIONS))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package (pip install zstandard)')
+    if level is None:
+        level = COMPRESSION_LEVELS[compression]
+
+    blob = get_client().bucket(bucket_name).blob(destination_blob_name, chunk_size=STREAM_CHUNK_SIZE)
+    content_type = mimetypes.guess_type(source_file_name)[0] or 'application/octet-stream'
+    if compression == 'gzip':
+        blob.content_encoding = 'gzip'
+    else:
+        blob.metadata = {COMPRESSION_METADATA_KEY: compression}
+
+    with open(source_file_name, 'rb') as source_file:
+        if compression == 'gzip':
+            chunks = _gzip_blocks(source_file, level, workers)
+        else:
+            chunks = _zstd_chunks(source_file, level, workers)
+        blob.upload_from_file(_ChunkReader(iter(chunks)), content_type=content_type, checksum='crc32c')
+
+    print("Compressed {} bytes to {} with {}.".format(
+        os.path.getsize(source_file_name), blob.size, compression))
+    return blob
+
+
+def file_crc32c(file_name):
+    """Returns the base64 crc32c of a local file, as GCS reports it."""
+    checksum = google_crc32c.Checksum()
+    with open(file_name, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('ascii')
+
+
+class ChecksumCache:
+    """
+    Thread-safe SQLite cache of local file checksums keyed by path, size and
+    modification time, so re-runs don't hash unchanged files again.
+    """
+
+    def __init__(self, path=CHECKSUM_CACHE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, crc32c TEXT'
+            ') WITHOUT ROWID')
+
+    def crc32c(self, file_name, stat=None):
+        """Returns the file's crc32c, hashing it only if it changed since last time."""
+        path = os.path.abspath(file_name)
+        stat = stat or os.stat(path)
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT crc32c FROM files WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        crc32c = file_crc32c(path)
+        self.remember(path, crc32c, stat)
+        return crc32c
+
+    def remember(self, file_name, crc32c, stat=None):
+        """Records a checksum already known, e.g. that of a verified download."""
+        path = os.path.abspath(file_name)
+        stat = stat or os.stat(path)
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              (path, stat.st_size, stat.st_mtime_ns, crc32c))
+            self.pending += 1
+            if self.pending >= 1000:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def _scan_files(directory):
+    """Walks a directory tree with os.scandir, yielding (path, stat) for each file."""
+    pending = [directory]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat()
+
+
+def upload_directory(bucket_name, source_directory, prefix='', workers=DEFAULT_WORKERS,
+                     cache_path=CHECKSUM_CACHE):
+    """
+    Uploads a directory tree to the bucket under prefix, which is treated
+    as a folder. Files are uploaded by a worker pool while the scan is
+    still running, and files whose crc32c matches the object already in the
+    bucket are skipped.
+    """
+    # bucket_name = "your-bucket-name"
+    # source_directory = "local/path/to/directory"
+    # prefix = "backups/2024-06-01/"
+
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+
+    # One listing of the destination tells us what is already there.
+    fields = 'items(name,crc32c),nextPageToken'
+    remote = {blob.name: blob.crc32c
+              for blob in get_client().list_blobs(bucket_name, prefix=prefix or None, fields=fields)}
+
+    cache = ChecksumCache(cache_path)
+    uploaded = Progress('Uploaded')
+    skipped = 0
+    failed = []
+
+    def upload_one(scanned):
+        file_name, stat = scanned
+        relative = os.path.relpath(file_name, source_directory).replace(os.sep, '/')
+        blob_name = prefix + relative
+        if remote.get(blob_name) and remote[blob_name] == cache.crc32c(file_name, stat):
+            return False
+        # Each file is already one of many in flight, so big ones go up as a
+        # single resumable stream rather than a composite of parts.
+        upload_blob(bucket_name, file_name, blob_name, parts=1, workers=1)
+        return True
+
+    try:
+        for (file_name, stat), future in bounded_map(upload_one, _scan_files(source_directory), workers):
+            try:
+                if future.result():
+                    uploaded.add(1)
+                else:
+                    skipped += 1
+            except (OSError, exceptions.GoogleAPICallError) as error:
+                print('Failed to upload {}: {}'.format(file_name, error))
+                failed.append(file_name)
+    finally:
+        cache.close()
+
+    uploaded.report()
+    print('{} files unchanged, {} failed.'.format(skipped, len(failed)))
+    return failed
+
+
+class _SliceWriter:
+    """
+    Write-only file object for one slice of a sliced download. Data goes
+    straight to its offset in the destination with os.pwrite, and the
+    slice's crc32c is kept up to date as it arrives.
+    """
+
+    def __init__(self, fd, state, on_progress):
+        # state is the slice's [start, end, done, crc32c] entry.
+        self.fd = fd
+        self.state = state
+        self.on_progress = on_progress
+        self.unsaved = 0
+
+    def write(self, data):
+        start, end, done, crc = self.state
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, start + done)
+            done += written
+            view = view[written:]
+        # One slice assignment, so a concurrent save never sees done and
+        # crc32c out of step.
+        self.state[2:4] = [done, google_crc32c.extend(crc, data)]
+
+        self.unsaved += len(data)
+        if self.unsaved >= STATE_SAVE_INTERVAL:
+            self.unsaved = 0
+            self.on_progress()
+        return len(data)
+
+
+def _load_slice_state(state_path, blob):
+    """Returns the saved slices of an interrupted download of this generation, if any."""
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    if state.get('generation') != blob.generation or state.get('size') != blob.size:
+        return None
+    return state['slices']
+
+
+def download_blob_sliced(blob, destination_file_name, slices=DOWNLOAD_SLICES, workers=DEFAULT_WORKERS):
+    """
+    Downloads a large blob as concurrent byte-range requests written in
+    place into a preallocated file. Progress is saved alongside the file,
+    so an interrupted download resumes each slice where it stopped. The
+    whole-object crc32c is checked from the per-slice checksums.
+    """
+    # blob = bucket.get_blob("storage-object-name")
+    # destination_file_name = "local/path/to/file"
+
+    if not blob.size:
+        # Nothing to slice.
+        open(destination_file_name, 'wb').close()
+        return
+
+    state_path = destination_file_name + SLICE_STATE_SUFFIX
+    saved = _load_slice_state(state_path, blob) if os.path.exists(destination_file_name) else None
+
+    fd = os.open(destination_file_name, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if saved is None:
+            slice_size = -(-blob.size // slices)
+            saved = [[start, min(start + slice_size, blob.size), 0, 0]
+                     for start in range(0, blob.size, slice_size)]
+            os.ftruncate(fd, blob.size)
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, blob.size)
+        else:
+            print('Resuming download of {}'.format(blob.name))
+
+        lock = threading.Lock()
+
+        def save_state():
+            # Snapshot before syncing, so the state file only ever claims
+            # bytes that are already on disk.
+            with lock:
+                snapshot = [list(state) for state in saved]
+                os.fsync(fd)
+                with open(state_path + '.tmp', 'w') as state_file:
+                    json.dump({'generation': blob.generation, 'size': blob.size, 'slices': snapshot}, state_file)
+                os.replace(state_path + '.tmp', state_path)
+
+        save_state()
+
+        def download_slice(state):
+            start, end, done, crc = state
+            if start + done < end:
+                # Pin the generation so every slice reads the same data. The
+                # ranges skip per-request checksums; the whole object is
+                # verified below.
+                source = get_client().bucket(blob.bucket.name).blob(blob.name, generation=blob.generation)
+                source.download_to_file(
+                    _SliceWriter(fd, state, save_state), start=start + done, end=end - 1,
+                    raw_download=True, checksum=None)
+
+        try:
+            for state, future in bounded_map(download_slice, saved, min(workers, len(saved))):
+                future.result()
+        finally:
+            save_state()
+
+        crc = saved[0][3]
+        for start, end, done, slice_crc in saved[1:]:
+            crc = _crc32c_combine(crc, slice_crc, end - start)
+        if blob.crc32c and crc != _decode_crc32c(blob.crc32c):
+            # Neither the data nor the progress can be trusted, so the next
+            # attempt starts over.
+            os.remove(state_path)
+            os.remove(destination_file_name)
+            raise ValueError('crc32c of downloaded {} is {}, expected {}'.format(
+                destination_file_name, _encode_crc32c(crc), blob.crc32c))
+    finally:
+        os.close(fd)
+
+    os.remove(state_path)
+
+
+def _download(blob, destination_file_name, slices, threshold, workers):
+    """
+    Downloads a blob whose metadata is already known, sliced if it's big
+    enough and decompressed if it was uploaded compressed.
+    """
+    # Byte ranges of compressed data wouldn't line up with the file, so
+    # compressed objects always take a single stream.
+    compression = _compression(blob)
+    source = get_client().bucket(blob.bucket.name).blob(blob.name, generation=blob.generation)
+
+    if compression == 'zstd':
+        _download_zstd(source, destination_file_name)
+    elif slices > 1 and blob.size and blob.size >= threshold and not blob.content_encoding:
+        download_blob_sliced(blob, destination_file_name, slices=slices, workers=workers)
+    else:
+        # gzip encoded objects are decompressed as they're read.
+        source.download_to_filename(destination_file_name)
+
+
+def _download_zstd(blob, destination):
+    """
+    Streams a zstd compressed blob through a decompressor into destination,
+    a file name or a writable file object. The crc32c of the stored,
+    compressed data is checked as it's read.
+    """
+    if zstandard is None:
+        raise ValueError('{} is zstd compressed, which needs the zstandard package '
+                         '(pip install zstandard)'.format(blob.name))
+
+    decompressor = zstandard.ZstdDecompressor()
+    if isinstance(destination, str):
+        with open(destination, 'wb') as destination_file:
+            _download_zstd(blob, destination_file)
+        return
+
+    with decompressor.stream_writer(destination, closefd=False) as writer:
+        blob.download_to_file(writer, raw_download=True, checksum='crc32c')
+
+
+def download_blob(bucket_name, source_blob_name, destination_file_name, slices=DOWNLOAD_SLICES,
+                  threshold=SLICED_DOWNLOAD_THRESHOLD, workers=DEFAULT_WORKERS):
+    """
+    Downloads a blob from the bucket. Blobs of threshold bytes or more are
+    fetched as concurrent byte-range slices.
+    """
     # The ID of your GCS bucket
     # bucket_name = "your-bucket-name"
 
@@ -37,16 +1006,17 @@ def download_blob(bucket_name, source_blob_name, destination_file_name):
     # The path to which the file should be downloaded
     # destination_file_name = "local/path/to/file"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
 
     bucket = storage_client.bucket(bucket_name)
 
-    # Construct a client side representation of a blob.
-    # Note `Bucket.blob` differs from `Bucket.get_blob` as it doesn't retrieve
-    # any content from Google Cloud Storage. As we don't need additional data,
-    # using `Bucket.blob` is preferred here.
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+    # `Bucket.get_blob` fetches the object's metadata, which is needed to
+    # decide between a single stream and a sliced download.
+    blob = bucket.get_blob(source_blob_name)
+    if blob is None:
+        raise exceptions.NotFound('Blob {} not found in bucket {}'.format(source_blob_name, bucket_name))
+
+    _download(blob, destination_file_name, slices, threshold, workers)
 
     print(
         "Downloaded storage object {} from bucket {} to local file {}.".format(
@@ -54,12 +1024,231 @@ def download_blob(bucket_name, source_blob_name, destination_file_name):
         )
     )
 
+
+def _glob_prefix(pattern):
+    """Returns the literal part of a glob pattern before its first wildcard."""
+    for index, char in enumerate(pattern):
+        if char in '*?[':
+            return pattern[:index]
+    return pattern
+
+
+def download_prefix(bucket_name, pattern, destination_directory, workers=DEFAULT_WORKERS,
+                    cache_path=CHECKSUM_CACHE):
+    """
+    Downloads every blob under a prefix, or matching a glob such as
+    'logs/2024-*/*.gz', into a local directory tree. The listing is streamed
+    into a bounded worker pool, and files already present with a matching
+    crc32c are skipped.
+    """
+    # bucket_name = "your-bucket-name"
+    # pattern = "logs/2024-06-*"
+    # destination_directory = "local/path/to/directory"
+
+    prefix = _glob_prefix(pattern)
+    is_glob = prefix != pattern
+    root = os.path.abspath(destination_directory)
+
+    fields = 'items(name,size,crc32c,generation,contentEncoding,metadata),nextPageToken'
+    blobs = (blob for blob in get_client().list_blobs(bucket_name, prefix=prefix or None, fields=fields)
+             if not blob.name.endswith('/') and (not is_glob or fnmatch.fnmatchcase(blob.name, pattern)))
+
+    cache = ChecksumCache(cache_path)
+    downloaded = Progress('Downloaded')
+    skipped = 0
+    failed = []
+
+    def download_one(blob):
+        file_name = os.path.normpath(os.path.join(root, *blob.name.split('/')))
+        if not file_name.startswith(root + os.sep):
+            raise ValueError('{} would be written outside {}'.format(blob.name, root))
+
+        if os.path.isfile(file_name) and os.path.getsize(file_name) == blob.size \
+                and cache.crc32c(file_name) == blob.crc32c:
+            return False
+
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        # Parallelism comes from the pool, so each object takes one stream.
+        _download(blob, file_name, 1, 0, 1)
+        # The crc32c of compressed objects is of the stored data, not the file.
+        if not _compression(blob):
+            cache.remember(file_name, blob.crc32c)
+        return True
+
+    try:
+        for blob, future in bounded_map(download_one, blobs, workers):
+            try:
+                if future.result():
+                    downloaded.add(1)
+                else:
+                    skipped += 1
+            except (OSError, ValueError, exceptions.GoogleAPICallError) as error:
+                print('Failed to download {}: {}'.format(blob.name, error))
+                failed.append(blob.name)
+    finally:
+        cache.close()
+
+    downloaded.report()
+    print('{} files already up to date, {} failed.'.format(skipped, len(failed)))
+    return failed
+
+
+class _RingReader:
+    """
+    File object over a non-seekable stream such as stdin. A background
+    thread reads ahead into a fixed ring of buffers, so the producer keeps
+    writing while earlier chunks are on the network, and memory stays at
+    buffers * chunk_size however long the stream runs.
+    """
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK_SIZE, buffers=STREAM_BUFFERS):
+        self.stream = stream
+        self.position = 0
+        self.current = memoryview(b'')
+        self.current_buffer = None
+        self.final = False
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for _ in range(buffers):
+            self.free.put(bytearray(chunk_size))
+        self.error = None
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while True:
+                buffer = self.free.get()
+                view = memoryview(buffer)
+                length = 0
+                while length < len(buffer):
+                    read = self.stream.readinto(view[length:])
+                    if not read:
+                        break
+                    length += read
+                self.filled.put((buffer, length))
+                if length < len(buffer):
+                    return
+        except Exception as error:
+            self.error = error
+            self.filled.put((None, 0))
+
+    def _next_buffer(self):
+        """Hands the spent buffer back to the reader and takes the next full one."""
+        if self.current_buffer is not None:
+            self.free.put(self.current_buffer)
+        buffer, length = self.filled.get()
+        if buffer is None:
+            raise self.error
+        # A short buffer is the last one the reader will fill.
+        self.final = length < len(buffer)
+        self.current_buffer = buffer
+        self.current = memoryview(buffer)[:length]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        chunks = []
+        while size > 0:
+            if not self.current:
+                if self.final:
+                    break
+                self._next_buffer()
+                continue
+            take = min(size, len(self.current))
+            chunks.append(bytes(self.current[:take]))
+            self.current = self.current[take:]
+            self.position += take
+            size -= take
+        return b''.join(chunks)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        # Resumable uploads only ever "seek" to where they already are.
+        if whence == io.SEEK_CUR:
+            position += self.position
+        if whence == io.SEEK_END or position != self.position:
+            raise io.UnsupportedOperation('stream is not seekable')
+        return self.position
+
+
+def upload_stream(bucket_name, stream, destination_blob_name, content_type=None,
+                  chunk_size=STREAM_CHUNK_SIZE, buffers=STREAM_BUFFERS):
+    """
+    Uploads a stream of unknown length, such as stdin, as a chunked
+    resumable upload, so `pg_dump | gzip | gs_objects.py -u -` needs no
+    staging on disk and no more memory than a few chunks.
+    """
+    # bucket_name = "your-bucket-name"
+    # stream = sys.stdin.buffer
+    # destination_blob_name = "storage-object-name"
+
+    blob = get_client().bucket(bucket_name).blob(destination_blob_name, chunk_size=chunk_size)
+    blob.upload_from_file(_RingReader(stream, chunk_size, buffers), content_type=content_type,
+                          checksum='crc32c')
+
+    print("Stream uploaded to {} ({} bytes).".format(destination_blob_name, blob.size), file=sys.stderr)
+    return blob
+
+
+def download_stream(bucket_name, source_blob_name, stream, chunk_size=STREAM_CHUNK_SIZE,
+                    buffers=STREAM_BUFFERS):
+    """
+    Writes a blob to a stream such as stdout. Up to buffers chunks are
+    fetched ahead as concurrent range requests, then written in order; the
+    crc32c of what was written is checked at the end.
+    """
+    # bucket_name = "your-bucket-name"
+    # source_blob_name = "storage-object-name"
+    # stream = sys.stdout.buffer
+
+    blob = get_client().bucket(bucket_name).get_blob(source_blob_name)
+    if blob is None:
+        raise exceptions.NotFound('Blob {} not found in bucket {}'.format(source_blob_name, bucket_name))
+
+    if _compression(blob) == 'zstd':
+        _download_zstd(blob, stream)
+        stream.flush()
+        return blob
+    if blob.content_encoding:
+        # Served decompressed, so stored byte ranges don't apply.
+        blob.download_to_file(stream)
+        stream.flush()
+        return blob
+
+    def fetch(start):
+        source = get_client().bucket(bucket_name).blob(source_blob_name, generation=blob.generation)
+        return source.download_as_bytes(start=start, end=min(start + chunk_size, blob.size) - 1,
+                                        raw_download=True, checksum=None)
+
+    starts = iter(range(0, blob.size, chunk_size))
+    crc = 0
+
+    with ThreadPoolExecutor(max_workers=buffers) as executor:
+        ahead = deque(executor.submit(fetch, start) for start in itertools.islice(starts, buffers))
+        while ahead:
+            data = ahead.popleft().result()
+            start = next(starts, None)
+            if start is not None:
+                ahead.append(executor.submit(fetch, start))
+            stream.write(data)
+            crc = google_crc32c.extend(crc, data)
+    stream.flush()
+
+    if blob.crc32c and crc != _decode_crc32c(blob.crc32c):
+        raise ValueError('crc32c of streamed {} is {}, expected {}'.format(
+            source_blob_name, _encode_crc32c(crc), blob.crc32c))
+    return blob
+
+
 def delete_blob(bucket_name, blob_name):
     """Deletes a blob from the bucket."""
     # bucket_name = "your-bucket-name"
     # blob_name = "your-object-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
 
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
@@ -68,6 +1257,48 @@ def delete_blob(bucket_name, blob_name):
     print("Blob {} deleted.".format(blob_name))
 
 
+def _delete_batch(bucket_name, blobs):
+    """Deletes a group of (blob_name, generation) pairs in one batch request."""
+    storage_client = get_client()
+    bucket = storage_client.bucket(bucket_name)
+
+    try:
+        with storage_client.batch():
+            for blob_name, generation in blobs:
+                bucket.delete_blob(blob_name, generation=generation)
+    except exceptions.GoogleAPICallError:
+        # A batch raises on its first failed call. Retry the group one by one
+        # so objects removed by someone else don't abort the rest.
+        for blob_name, generation in blobs:
+            try:
+                bucket.delete_blob(blob_name, generation=generation)
+            except exceptions.NotFound:
+                pass
+
+    return len(blobs)
+
+
+def delete_blobs(bucket_name, blobs, workers=DEFAULT_WORKERS, batch_size=DELETE_BATCH_SIZE):
+    """
+    Deletes a stream of (blob_name, generation) pairs from the bucket,
+    running several batch requests at once. A generation of None deletes
+    the live version. Returns the number of blobs deleted.
+    """
+    # bucket_name = "your-bucket-name"
+    # blobs = iter([("your-object-name", None)])
+
+    progress = Progress('Deleted')
+
+    def delete_group(group):
+        return _delete_batch(bucket_name, group)
+
+    for group, future in bounded_map(delete_group, _chunked(blobs, batch_size), workers):
+        progress.add(future.result())
+
+    progress.report()
+    return progress.count
+
+
 def rename_blob(bucket_name, blob_name, new_name):
     """Renames a blob."""
     # The ID of your GCS bucket
@@ -77,7 +1308,7 @@ def rename_blob(bucket_name, blob_name, new_name):
     # The new ID of the GCS object
     # new_name = "new-object-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
 
@@ -95,7 +1326,7 @@ def copy_blob(
     # destination_bucket_name = "destination-bucket-name"
     # destination_blob_name = "destination-object-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
 
     source_bucket = storage_client.bucket(bucket_name)
     source_blob = source_bucket.blob(blob_name)
@@ -115,6 +1346,35 @@ def copy_blob(
     )
 
 
+def rewrite_blob(
+    bucket_name, blob_name, destination_bucket_name, destination_blob_name,
+    generation=None, token=None, on_progress=None
+):
+    """
+    Copies a blob server-side with the rewrite API, following rewrite tokens
+    until the copy completes. Large cross-location or cross-class copies
+    take several calls; on_progress(token, bytes_rewritten, total_bytes) is
+    called after each one so callers can save the token and resume later.
+    """
+    # bucket_name = "your-bucket-name"
+    # blob_name = "your-object-name"
+    # destination_bucket_name = "destination-bucket-name"
+    # destination_blob_name = "destination-object-name"
+
+    storage_client = get_client()
+
+    # Pinning the generation keeps every call of the rewrite on the same data.
+    source_blob = storage_client.bucket(bucket_name).blob(blob_name, generation=generation)
+    destination_blob = storage_client.bucket(destination_bucket_name).blob(destination_blob_name)
+
+    while True:
+        token, bytes_rewritten, total_bytes = destination_blob.rewrite(source_blob, token=token)
+        if on_progress:
+            on_progress(token, bytes_rewritten, total_bytes)
+        if token is None:
+            return destination_blob
+
+
 def move_blob(bucket_name, blob_name, destination_bucket_name, destination_blob_name):
     """Moves a blob from one bucket to another with a new name."""
     # The ID of your GCS bucket
@@ -126,7 +1386,7 @@ def move_blob(bucket_name, blob_name, destination_bucket_name, destination_blob_
     # The ID of your new GCS object (optional)
     # destination_blob_name = "destination-object-name"
 
-    storage_client = storage.Client()
+    storage_client = get_client()
 
     source_bucket = storage_client.bucket(bucket_name)
     source_blob = source_bucket.blob(blob_name)
@@ -147,34 +1407,205 @@ def move_blob(bucket_name, blob_name, destination_bucket_name, destination_blob_
     )
 
 
+class _MoveJournal:
+    """
+    Append-only journal of a prefix move. Each object is recorded once it
+    has been copied and again once its source has been deleted, so after a
+    crash it's clear exactly which objects have moved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a killed run.
+                        continue
+                    self.states[entry['name']] = (entry['generation'], entry['state'])
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self.file = open(path, 'a')
+
+    def is_copied(self, blob_name, generation):
+        return self.states.get(blob_name, (None, None))[0] == generation
+
+    def record(self, blob_name, generation, state):
+        line = json.dumps({'name': blob_name, 'generation': generation, 'state': state})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _move_journal_path(bucket_name, prefix, destination_bucket_name, destination_prefix):
+    move = '\n'.join((bucket_name, prefix, destination_bucket_name, destination_prefix))
+    digest = hashlib.sha1(move.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(MOVE_JOURNAL_DIR, '{}--{}-{}.jsonl'.format(bucket_name, destination_bucket_name, digest))
+
+
+def move_prefix(bucket_name, prefix, destination_bucket_name, destination_prefix,
+                workers=DEFAULT_WORKERS, journal_path=None):
+    """
+    Moves every blob under prefix to destination_prefix, in the same or
+    another bucket. Server-side copies run concurrently and the sources are
+    deleted in batches behind them. A journal makes the move resumable:
+    running it again skips copies already made and finishes the deletes.
+    """
+    # bucket_name = "your-bucket-name"
+    # prefix = "old/directory/"
+    # destination_bucket_name = "destination-bucket-name"
+    # destination_prefix = "new/directory/"
+
+    # Within one bucket, overlapping prefixes would have copies landing on
+    # (or being listed as) sources that haven't been moved yet.
+    if bucket_name == destination_bucket_name and (
+            destination_prefix.startswith(prefix) or prefix.startswith(destination_prefix)):
+        raise ValueError("Can't move {} to the overlapping prefix {}".format(prefix, destination_prefix))
+
+    if journal_path is None:
+        journal_path = _move_journal_path(bucket_name, prefix, destination_bucket_name, destination_prefix)
+    journal = _MoveJournal(journal_path)
+    print('Move journal:', journal_path)
+
+    fields = 'items(name,generation),nextPageToken'
+    listed = ((blob.name, blob.generation)
+              for blob in get_client().list_blobs(bucket_name, prefix=prefix, fields=fields))
+
+    def copy_one(ref):
+        blob_name, generation = ref
+        if not journal.is_copied(blob_name, generation):
+            rewrite_blob(bucket_name, blob_name, destination_bucket_name,
+                         destination_prefix + blob_name[len(prefix):], generation=generation)
+            journal.record(blob_name, generation, 'copied')
+
+    def delete_group(group):
+        # Deleting the copied generation only, so an object overwritten
+        # since it was copied is left alone.
+        _delete_batch(bucket_name, group)
+        for blob_name, generation in group:
+            journal.record(blob_name, generation, 'deleted')
+        return len(group)
+
+    moved = Progress('Moved')
+    failed = []
+    copied = []
+    deleting = {}
+
+    def finish(deleted):
+        group = deleting.pop(deleted)
+        try:
+            moved.add(deleted.result())
+        except exceptions.GoogleAPICallError as error:
+            # The copies are journalled, so the next run only retries the deletes.
+            print('Failed to delete {} moved sources: {}'.format(len(group), error))
+            failed.extend(blob_name for blob_name, generation in group)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers // 4)) as delete_pool:
+            for ref, future in bounded_map(copy_one, listed, workers):
+                try:
+                    future.result()
+                except exceptions.GoogleAPICallError as error:
+                    print('Failed to move {}: {}'.format(ref[0], error))
+                    failed.append(ref[0])
+                    continue
+
+                copied.append(ref)
+                if len(copied) == DELETE_BATCH_SIZE:
+                    deleting[delete_pool.submit(delete_group, copied)] = copied
+                    copied = []
+                if len(deleting) > workers:
+                    done, _ = wait(deleting, return_when=FIRST_COMPLETED)
+                    for deleted in done:
+                        finish(deleted)
+
+            if copied:
+                deleting[delete_pool.submit(delete_group, copied)] = copied
+            for deleted in as_completed(list(deleting)):
+                finish(deleted)
+    finally:
+        journal.close()
+
+    moved.report()
+    if failed:
+        print('{} blobs failed to move. Run the move again to retry them.'.format(len(failed)))
+    return failed
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("-u", "--upload", metavar="object_name", help="Upload object")
+    parser.add_argument("-u", "--upload", metavar="object_name", help="Upload object ('-' reads stdin)")
+    parser.add_argument("-U", "--upload-dir", metavar="directory", help="Upload a directory tree, skipping unchanged files")
     parser.add_argument("-d", "--download", metavar="object_name", help="Download object")
+    parser.add_argument("-o", "--output", metavar="file_name", help="Local file for --download ('-' writes stdout)")
+    parser.add_argument("--content-type", help="Content type of an object uploaded from stdin")
+    parser.add_argument("--chunk-size", type=parse_size, default=STREAM_CHUNK_SIZE, help="Chunk size of stdin/stdout transfers, a multiple of 256K")
+    parser.add_argument("-D", "--download-prefix", metavar="prefix_or_glob", help="Download every object under a prefix or matching a glob")
+    parser.add_argument("--local-dir", default=".", help="Local directory for --download-prefix")
     parser.add_argument("-r", "--rename", metavar="object_name", help="Rename object")
     parser.add_argument("-n", "--newname", metavar="object_name", help="New name for object")
     parser.add_argument("-c", "--copy", metavar="object_name", help="Copy object")
     parser.add_argument("-m", "--move", metavar="object_name", help="Move object")
+    parser.add_argument("-M", "--move-prefix", metavar="prefix", help="Move every object under a prefix to the --newname prefix")
     parser.add_argument("--dest", metavar="bucket_name", help="Destination bucket")
     parser.add_argument("--delete", metavar="object_name", help="Delete object")
     parser.add_argument("-b", "--bucket", metavar="bucket_name", help="Bucket name")
+    parser.add_argument("--prefix", default="", help="Object name prefix for directory transfers")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent requests for parallel transfers")
+    parser.add_argument("--parts", type=int, default=COMPOSITE_PARTS, help="Slices for parallel composite uploads (1 disables them)")
+    parser.add_argument("--composite-threshold", type=parse_size, default=COMPOSITE_UPLOAD_THRESHOLD, help="Smallest file uploaded as a parallel composite upload, e.g. 150M")
+    parser.add_argument("--resumable-threshold", type=parse_size, default=RESUMABLE_THRESHOLD, help="Smallest non-composite upload that saves its session to resume after interruptions")
+    parser.add_argument("--compress", choices=COMPRESSIONS, help="Compress uploads on the fly (zstd needs the zstandard package)")
+    parser.add_argument("--slices", type=int, default=DOWNLOAD_SLICES, help="Byte ranges fetched at once by sliced downloads (1 disables them)")
+    parser.add_argument("--sliced-threshold", type=parse_size, default=SLICED_DOWNLOAD_THRESHOLD, help="Smallest object downloaded in slices, e.g. 150M")
+    parser.add_argument("--pool-size", type=int, help="HTTP connections to keep open to Cloud Storage (default: enough for --workers)")
     args = parser.parse_args()
 
-    if args.upload and args.bucket:
+    configure(pool_size=args.pool_size or max(DEFAULT_POOL_SIZE, args.workers))
+
+    if args.upload == '-' and args.bucket:
+        if not args.newname:
+            print('Uploading from stdin needs an object name (--newname)', file=sys.stderr)
+            exit()
+        upload_stream(args.bucket, sys.stdin.buffer, args.newname, content_type=args.content_type,
+                      chunk_size=args.chunk_size)
+
+    elif args.upload and args.bucket:
         source_file_name = args.upload
         bucket_name = args.bucket
         if args.newname:
             destination_blob_name = args.newname
         else:
             destination_blob_name = args.upload
-        upload_blob(bucket_name, source_file_name, destination_blob_name)
+        upload_blob(bucket_name, source_file_name, destination_blob_name, parts=args.parts,
+                    threshold=args.composite_threshold, workers=args.workers,
+                    resumable_threshold=args.resumable_threshold, compression=args.compress)
 
-    if args.download and args.bucket:
+    if args.upload_dir and args.bucket:
+        upload_directory(args.bucket, args.upload_dir, prefix=args.prefix, workers=args.workers)
+
+    if args.download and args.bucket and args.output == '-':
+        download_stream(args.bucket, args.download, sys.stdout.buffer, chunk_size=args.chunk_size)
+
+    elif args.download and args.bucket:
         source_blob_name = args.download
-        destination_file_name = args.download
+        destination_file_name = args.output or args.download
         bucket_name = args.bucket
-        download_blob(bucket_name, source_blob_name, destination_file_name)
+        download_blob(bucket_name, source_blob_name, destination_file_name, slices=args.slices,
+                      threshold=args.sliced_threshold, workers=args.workers)
+
+    if args.download_prefix and args.bucket:
+        download_prefix(args.bucket, args.download_prefix, args.local_dir, workers=args.workers)
 
     if args.delete and args.bucket:
         blob_name = args.delete
@@ -216,3 +1647,19 @@ if __name__ == '__main__':
             print('destination_blob_name:', destination_blob_name)
 
         copy_blob(bucket_name, blob_name, destination_bucket_name, destination_blob_name)
+
+    if args.move and args.bucket:
+        destination_bucket_name = args.dest or args.bucket
+        destination_blob_name = args.newname or args.move
+        if (args.bucket, args.move) == (destination_bucket_name, destination_blob_name):
+            print('Source object and destination object are identical')
+            exit()
+        move_blob(args.bucket, args.move, destination_bucket_name, destination_blob_name)
+
+    if args.move_prefix and args.bucket:
+        destination_bucket_name = args.dest or args.bucket
+        if args.newname is None and destination_bucket_name == args.bucket:
+            print('Moving a prefix within a bucket needs a new prefix (--newname)')
+            exit()
+        move_prefix(args.bucket, args.move_prefix, destination_bucket_name,
+                    args.newname if args.newname is not None else args.move_prefix, workers=args.workers)